@@ -11,35 +11,31 @@ add time: 10 May, 2023
 import os,sys
 from optparse import OptionParser
 from datetime import datetime
-from datetime import timedelta
 from netrc import netrc
 import dateutil.parser
 from urllib.parse import urlparse
-import time
 import re
-from multiprocessing import Process
+import threading
 
 deeplabforRS =  os.path.expanduser('~/codes/PycharmProjects/DeeplabforRS')
 sys.path.insert(0, deeplabforRS)
 
 import vector_gpd
 from vector_gpd import shapefile_to_ROIs_wkt
-from vector_gpd import wkt_string_to_polygons
 import basic_src.io_function as io_function
 import basic_src.basic as basic
 
-from asarapi.catalog import query
+from asarapi.catalog import query, query_many, connect
+from asarapi.download import log_in, log_out, download_many
+from asarapi.footprints import filter_coverage
+from asarapi.archive import ArchiveIndex
+from asarapi.ledger import Ledger, DONE, FAILED, UNAVAILABLE
 import pandas as pd
 
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-admin_url = 'https://esar-ds.eo.esa.int/oads/access/login'
-
 machine_name = os.uname()[1]
-download_tasks = []
-login_window_handle = None
-not_available_list = []
+download_ledger = None
+archive_indexes = {}    # index of the files in each save directory
+archive_indexes_lock = threading.Lock()
 
 b_rm_small_overlap = True
 
@@ -69,6 +65,12 @@ def create_soft_link(dir,old_filename, new_filename):
     basic.os_system_exit_code(cmd_str)
     os.chdir(current_dir)
 
+def get_archive_index(dir_name):
+    with archive_indexes_lock:
+        if dir_name not in archive_indexes:
+            archive_indexes[dir_name] = ArchiveIndex(dir_name)
+        return archive_indexes[dir_name]
+
 def does_ERS_file_exist(file_name, dir_name):
     # it's strange that download file name of ERS imagery is different the filename in the URL and ID.
     # for example,
@@ -82,50 +84,15 @@ def does_ERS_file_exist(file_name, dir_name):
     if os.path.isfile(save_path):
         return True
 
-    datetime_format = '%Y%m%d_%H%M%S'
-
-    # try to search similar file names
-    diff = [i for i in range(-5,6)]
-    # diff.remove(0)
-    strs = file_name.split('_')
-    # change_term = int(strs[3]) # 203036
-    change_term_str = strs[2][6:]+'_'+strs[3]       # 20041031_203035
-    change_term = datetime.strptime(change_term_str, datetime_format)
-    strs[4] = '*'       # 00000015A099 change to something, not sure what it look like.
-    for ii in diff:
-        # add or substract a few second
-        # tmp = str(change_term + ii)
-        tmp = change_term + timedelta(seconds=ii)
-        tmp_str = tmp.strftime(datetime_format)
-        tmp_str_list = tmp_str.split('_')
-        strs[2] = strs[2].replace(strs[2][6:], tmp_str_list[0]) # replace 20041031 to a new date if happen
-        strs[3] = tmp_str_list[1]                               # change 203035 to a new time after adding a new seconds
-
-        new_name = '_'.join(strs)
-        file_list = io_function.get_file_list_by_pattern(dir_name,new_name)
-
-        # remove files are links or has created links
-        if len(file_list) > 1:
-            f_name_list = [ os.path.basename(item) for item in file_list]
-            rm_idxs = []
-            for idx, (f_name, f_path) in enumerate(zip(f_name_list,file_list)):
-                if os.path.islink(f_path):
-                    target = os.readlink(f_path)
-                    rm_idxs.append(idx)
-                    if target in f_name_list:
-                        rm_idxs.append(f_name_list.index(target))
-            file_list = [ file_list[idx] for idx in range(len(file_list)) if idx not in rm_idxs]
-
-        # print(new_name)
-        # if os.path.isfile(new_path):
-        #     basic.outputlogMessage('Warning, %s does not exists, but a file with similar name exists: %s'%(file_name,new_name))
-        #     return True
-        if len(file_list) == 1:
-            basic.outputlogMessage('Warning, %s does not exist, but a file with similar name exists: %s' % (file_name, file_list[0]))
-            create_soft_link(dir_name,file_name, os.path.basename(file_list[0]))
-            return True
+    # search similar file names (acquisition time within 5 seconds) in an index of the directory,
+    # which is only rescanned when the directory changes
+    found_path = get_archive_index(dir_name).find(file_name)
+    if found_path is None:
+        return False
 
-    return False
+    basic.outputlogMessage('Warning, %s does not exist, but a file with similar name exists: %s' % (file_name, found_path))
+    create_soft_link(dir_name,file_name, os.path.basename(found_path))
+    return True
 
 
 def test_does_ERS_file_exist():
@@ -135,138 +102,80 @@ def test_does_ERS_file_exist():
     dir_name = os.path.expanduser('~/Data/asar_ERS_Envisat/Envisat')
     print(does_ERS_file_exist(file_name, dir_name))
 
-def remove_record_only_cover_parts(query_results, aoi_wkt):
-    aoi_poly = wkt_string_to_polygons(aoi_wkt)
-    footprints = query_results['footprint'].to_list()
-    if len(footprints) < 1 or b_rm_small_overlap is False:
+def remove_record_only_cover_parts(query_results, aoi_wkt, min_footprint_coverage=0.2, min_aoi_coverage=0.5):
+    # keep records that have at least 1/5 of their footprint inside the AOI or that cover at least half of the AOI
+    if len(query_results) < 1 or b_rm_small_overlap is False:
         return query_results
-    footprint_polys = [wkt_string_to_polygons(item) for item in footprints]
-
-    sel_idx = []
-    for idx, fp in enumerate(footprint_polys):
-        intersection = aoi_poly.intersection(fp)
-        if intersection.area < fp.area/5 and intersection.area < aoi_poly.area/2:
-            continue
-        else:
-            sel_idx.append(idx)
-        # if intersection.is_empty is True:
-        #     return 0.0
-
-    # # test, saving to shapefile
-    # save_shp_path = 'query_results.gpkg'
-    # save_q_results = query_results.copy()
-    # save_q_results['outline'] = footprint_polys
-    # # 'ESRI Shapefile' dont support datetime format, but GPKG do
-    # vector_gpd.save_polygons_to_files(save_q_results,'outline','EPSG:4326',save_shp_path,format='GPKG')
-    # print('saved %s'%save_shp_path)
+    sel_results = filter_coverage(query_results, aoi_wkt, min_footprint_coverage=min_footprint_coverage,
+                                  min_aoi_coverage=min_aoi_coverage)
 
     basic.outputlogMessage('Originally found %d SAR images, removed %d records that only cover a small portions of the study area'
-                           %(len(footprint_polys), (len(footprint_polys) - len(sel_idx))))
-
-    return query_results.iloc[sel_idx]
+                           %(len(query_results), (len(query_results) - len(sel_results))))
+
+    return sel_results
+
+def get_download_ledger(save_dir):
+    # the ledger records the state of each product in save_dir, shared by all download threads
+    global download_ledger
+    if download_ledger is None or os.path.dirname(download_ledger.dbpath) != os.path.abspath(save_dir):
+        download_ledger = Ledger(os.path.join(os.path.abspath(save_dir), 'download_ledger.db'))
+        # import the list of unavailable files used previously
+        not_available_file = os.path.join(save_dir, 'not_available_list.txt')
+        if os.path.isfile(not_available_file):
+            for file_name in io_function.read_list_from_txt(not_available_file):
+                download_ledger.update(os.path.splitext(file_name)[0], UNAVAILABLE)
+    return download_ledger
+
+def url_to_product_id(url):
+    # the file name in the URL is the product ID plus the extension (.E2 or .N1)
+    return os.path.splitext(os.path.basename(urlparse(url).path))[0]
 
 def file_exist_not_available(url, save_dir):
     tmp = urlparse(url)
     file_name = os.path.basename(tmp.path)
     save_path = os.path.join(save_dir,file_name)
-    if does_ERS_file_exist(file_name, save_dir):
-        print('%s exists, skip downloading'%save_path)
+    ledger = get_download_ledger(save_dir)
+    state = ledger.state(url_to_product_id(url))
+    if state == DONE:
+        print('%s has been downloaded, skip downloading'%save_path)
         return True
-
-    # check not available list
-    if file_name in not_available_list:
+    if state == UNAVAILABLE:
         print('%s is not available according to the ESA website'%file_name)
         return True
+
+    if does_ERS_file_exist(file_name, save_dir):
+        print('%s exists, skip downloading'%save_path)
+        ledger.update(url_to_product_id(url), DONE, path=save_path)
+        return True
     return False
 
 
-def download_one_file_ESA(web_driver, url, save_dir):
+def automated_download_ASAR_ESA(session, data_urls,save_dir, max_process_num=8, min_free_GB=50):
 
-    tmp = urlparse(url)
-    file_name = os.path.basename(tmp.path)
-    save_path = os.path.join(save_dir,file_name)
-    if does_ERS_file_exist(file_name, save_dir):
-        print('%s exists, skip downloading'%save_path)
-        return
+    ledger = get_download_ledger(save_dir)
+    ledger.queue({url_to_product_id(url): url for url in data_urls})
 
-    # check not available list
-    if file_name in not_available_list:
-        print('%s is not available according to the ESA website'%file_name)
-        return
-
-    # check free disk space
-    free_GB = io_function.get_free_disk_space_GB(save_dir)
-    total_wait_time = 0
-    while free_GB < 50 and total_wait_time < 60 * 60 * 12:
-        basic.outputlogMessage(' The free disk space (%.4f) is less than 50 GB, wait 60 seconds' % free_GB)
-        time.sleep(60)
-        total_wait_time += 60
-        free_GB = io_function.get_free_disk_space_GB(save_dir)
-
-    basic.outputlogMessage('start downloading %s'%url)
-    web_driver.switch_to.window(login_window_handle) # switch to login window before opening a new tab
-    web_driver.switch_to.new_window('tab')
-    current_window_handle = web_driver.current_window_handle
-    web_driver.get(url)
-
-    # wait until the file has been downloaded
-    total_wait_time = 0
-    max_wait_time = 60 * 60 * 12  # max 12 hours
-    while does_ERS_file_exist(file_name, save_dir) is False and total_wait_time < max_wait_time:
-        time.sleep(60)
-        total_wait_time += 60
-    basic.outputlogMessage('downloaded: %s'%save_path)
-    if current_window_handle in web_driver.window_handles and total_wait_time < max_wait_time:
-        web_driver.switch_to.window(current_window_handle)
-        web_driver.close()
-        # need to switch to login page after close, otherwise, got error: no such window: target window already closed
-        web_driver.switch_to.window(login_window_handle)
-        print('close window %s, %d windows (tabs) still open'%(current_window_handle, len(web_driver.window_handles)))
-
-
-
-def automated_download_ASAR_ESA(web_driver, data_urls,save_dir, max_process_num=8):
-
-    global not_available_list
-    not_available_file = os.path.join(save_dir,'not_available_list.txt')
-    if os.path.isfile(not_available_file):
-        not_available_list = io_function.read_list_from_txt(not_available_file)
-
-
-    for ii, url in enumerate(data_urls):
-        # download in parallel
-        basic.check_exitcode_of_process(download_tasks)  # if there is one former job failed, then quit
-        while True:
-            job_count = basic.alive_process_count(download_tasks)
-            if job_count >= max_process_num:
-                print(machine_name, datetime.now(),'You are running %d or more tasks in parallel, wait ' % max_process_num)
-                time.sleep(60)  #
-                continue
-            break
-
-        # start the processing
-        print('Progress: %d/%d'%(ii+1, len(data_urls)))
-        if file_exist_not_available(url, save_dir):
-            continue
-        sub_process = Process(target=download_one_file_ESA, args=(web_driver,url, save_dir))  # start a process, don't wait
-        sub_process.start()
-        download_tasks.append(sub_process)
-        time.sleep(3)   # wait 3 seconds
-
-        basic.close_remove_completed_process(download_tasks)
-
-    # wait until all task complete
-    while True:
-        job_count = basic.alive_process_count(download_tasks)
-        if job_count > 0:
-            print(machine_name, datetime.now(), 'wait until all task are completed, alive task account: %d ' % job_count)
-            time.sleep(60)  #
-        else:
-            break
+    # download in parallel with a pool of threads sharing the logged-in session (HTTP, no browser)
+    todo_ids = [url_to_product_id(url) for url in data_urls if not file_exist_not_available(url, save_dir)]
+    print(machine_name, datetime.now(), '%d of %d files to download' % (len(todo_ids), len(data_urls)))
+    # each transfer reserves its size on the disk first, and waits while less than min_free_GB would be left
+    # (decimal GB of 10^9 bytes, as `asarapi download --min-free-space` and the summary below)
+    download_many(session, todo_ids, save_dir, workers=max_process_num, ledger=ledger,
+                  min_free_space=int(min_free_GB * 1e9))
 
+    summary = ledger.summary()
+    print(machine_name, datetime.now(), 'done: %d, unavailable: %d, failed: %d, %.1f GB downloaded (%.2f MB/s)'
+          % (summary[DONE], summary[UNAVAILABLE], summary[FAILED], summary['bytes'] / 1e9, summary['throughput'] / 1e6))
+
+    # download_many does not raise for a single product: the batch is only done once every product is
+    # downloaded or unavailable, so that the next run retries the failed ones (timeout, disk space, network)
+    failed = [pid for pid in todo_ids if not ledger.finished(pid)]
+    if len(failed) > 0:
+        print(machine_name, datetime.now(), '%d files failed to download, run again to retry them' % len(failed))
+        return False
     return True
 
-def download_ASAR_from_ESA(web_driver, extent_shp, save_dir, start, stop, platform=None, product='single-look-complex',orbit=None,
+def download_ASAR_from_ESA(session, extent_shp, save_dir, start, stop, platform=None, product='single-look-complex',orbit=None,
                            polarisation=None, contains=False, limit=500,process_num=8):
 
     if not os.path.isdir(save_dir):
@@ -277,18 +186,23 @@ def download_ASAR_from_ESA(web_driver, extent_shp, save_dir, start, stop, platfo
     if len(ROIs_wkt) < 1:
         raise ValueError('There is zero AOI')
 
-    for idx, aoi_wkt in enumerate(ROIs_wkt):
+    print(datetime.now(), 'Searching... ... ...')
+    print(datetime.now(), 'Input search parameters:')
+    print('number of roi_wkt:', len(ROIs_wkt))
+    print('save_dir, start_date, end_date:', save_dir, start, stop)
+    print('platform, product, flightDirection:', platform, product, orbit)
+    # remove some records only cover a small portions (less than half) of the study area,
+    # the coverage is computed by spatialite during the search
+    min_footprint_coverage, min_aoi_coverage = (0.2, 0.5) if b_rm_small_overlap else (None, None)
+    # search all AOIs in one pass, then split the results by AOI
+    all_results = query_many(ROIs_wkt, start, stop, platform=platform, product=product, orbit=orbit,
+                             polarisation=polarisation, contains=contains, limit=limit,
+                             min_footprint_coverage=min_footprint_coverage, min_aoi_coverage=min_aoi_coverage)
 
-        print(datetime.now(), 'Searching... ... ...')
-        print(datetime.now(), 'Input search parameters:')
-        print('roi_wkt:', aoi_wkt)
-        print('save_dir, start_date, end_date:', save_dir, start, stop)
-        print('platform, product, flightDirection:', platform, product, orbit)
+    for idx, aoi_wkt in enumerate(ROIs_wkt):
 
-        results = query(aoi_wkt,start, stop,platform=platform,product=product, orbit=orbit,polarisation=polarisation,
-              contains=contains, limit=limit)
-        # remove some records only cover a small portions (less than half) of the study area
-        results = remove_record_only_cover_parts(results, aoi_wkt)
+        print(datetime.now(), 'roi_wkt:', aoi_wkt)
+        results = all_results[all_results['aoi'].map(lambda aois: idx in aois)]
 
         print(datetime.now(), 'Found %s results' % (len(results)))
         print(datetime.now(), 'Downloading... ... ...')
@@ -297,16 +211,17 @@ def download_ASAR_from_ESA(web_driver, extent_shp, save_dir, start, stop, platfo
             data_meta_path = os.path.join(save_dir,'%s_meta.json'%ext_base_name)
         else:
             data_meta_path = os.path.join(save_dir, '%s_meta_%d.json' % (ext_base_name, idx))
-        done_indicator = data_meta_path + '_Done'
-        if os.path.isfile(done_indicator):
+        ledger = get_download_ledger(save_dir)
+        batch_name = os.path.basename(data_meta_path)
+        if ledger.batch_done(batch_name) or os.path.isfile(data_meta_path + '_Done'):
             print('Downloading imagery in %s has completed previously, skip'%data_meta_path)
             continue
         save_query_results(results,data_meta_path)
 
         # download data
         data_urls = results['url'].to_list()
-        if automated_download_ASAR_ESA(web_driver, data_urls, save_dir, max_process_num=process_num) is True:
-            io_function.save_list_to_txt(done_indicator, ['Complete at %s'%str(datetime.now())])
+        if automated_download_ASAR_ESA(session, data_urls, save_dir, max_process_num=process_num) is True:
+            ledger.mark_batch_done(batch_name)
 
 
 
@@ -336,62 +251,6 @@ def test_search():
 
 
 
-def ESA_log_in(save_dir,username,password):
-    # log in
-    # Step 1: Start a new instance of the Chrome browser using Selenium
-    # driver = webdriver.Chrome()
-    # Set download directory and options
-    options = webdriver.ChromeOptions()
-    options.add_experimental_option('prefs', {'download.default_directory': save_dir})
-    # Start a new instance of the Chrome browser using Selenium
-    driver = webdriver.Chrome(options=options)
-
-    # Step 2: Load the login page
-    driver.get(admin_url)
-    # Step 3: Wait for the page to load (use a timeout value that makes sense for your website)
-    driver.implicitly_wait(30)
-    time.sleep(30)
-
-    # Step 4: Enter the username and password
-    username_field = driver.find_element(By.NAME, 'usernameUserInput')
-    password_field = driver.find_element(By.NAME, 'password')
-    username_field.send_keys(username)
-    password_field.send_keys(password)
-
-    # Step 5: Submit the login form
-    password_field.send_keys(Keys.RETURN)
-
-    # Step 6: Wait for the page to load after submitting the form (use a timeout value that makes sense for your website)
-    driver.implicitly_wait(30)
-
-    # wait until the file has been downloaded
-    total_wait_time = 0
-    max_wait_time = 10 * 6* 10  # # max 10 minutes
-    signed_str = 'Signed in as %s' % username
-    while True:
-        print(datetime.now(), 'waiting for the login page')
-        time.sleep(20)
-        total_wait_time += 20
-        if signed_str in driver.page_source or total_wait_time >=  max_wait_time:
-            break
-    if total_wait_time < max_wait_time:
-        print('Login successful!')
-        # save the window handle
-        global login_window_handle
-        login_window_handle = driver.current_window_handle
-        return driver
-
-    driver.quit()
-    raise ValueError('Login failed!')
-
-def ESA_logout(web_driver):
-    LOGOUT_URL = 'https://esar-ds.eo.esa.int/oads/Shibboleth.sso/Logout'
-    # Navigate to the logout page
-    web_driver.get(LOGOUT_URL)
-    print(datetime.now(), 'Log out')
-    web_driver.quit()
-
-
 def main(options, args):
     extent_shp = args[0]
     assert os.path.isfile(extent_shp)
@@ -413,7 +272,7 @@ def main(options, args):
 
     print(datetime.now(), 'download data from ESA, start_date: %s, end_date: %s, user: %s \nwill save to %s'%(start_date,end_date,user_name,save_dir))
 
-    web_driver = ESA_log_in(save_dir,user_name,password)
+    session = log_in(user_name, password)
 
     if extent_shp.endswith('.txt'):
         print(datetime.now(), "the input is a TXT file")
@@ -427,11 +286,13 @@ def main(options, args):
         # (polarisation, ['VV', 'VH', 'HV', 'HH'])  None for all
 
         # download data
-        download_ASAR_from_ESA(web_driver, extent_shp, save_dir, start_date, end_date,
+        with connect():
+            download_ASAR_from_ESA(session, extent_shp, save_dir, start_date, end_date,
                                    platform=platform, product='single-look-complex',
                                    orbit=None,polarisation=None,contains=False,limit=500,process_num=process_num)
 
-    ESA_logout(web_driver)
+    log_out(session)
+    print(datetime.now(), 'Log out')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,118 @@
+"""Index of the products already present in a local archive directory.
+
+The file names of the downloaded ERS products do not always match the name
+in the download URL: the acquisition time may differ by a few seconds and
+the duration/cycle field may change, e.g.
+
+    SAR_IMS_1PNESA20041031_203036_00000015A099_00386_49839_0000.E2 (URL)
+    SAR_IMS_1PNESA20041031_203035_00000018A099_00386_49839_0000.E2 (file)
+
+`ArchiveIndex` groups the files of a directory by the fields that do not
+change (mission, product type, processing stage and centre, relative and
+absolute orbit, counter and extension) and keeps their acquisition times
+sorted, so that a product is found with a binary search of the time range
+instead of globbing the directory for every possible name.
+"""
+
+import os
+import re
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+
+# e.g. SAR_IMS_1PNESA20041031_203036_00000015A099_00386_49839_0000.E2
+_NAME = re.compile(r'^([A-Z0-9]{3})_(\w{3})_(\w{6})(\d{8})_(\d{6})_(\w{12})_'
+                   r'(\d{5})_(\d{5})_(\w{4})(\.\w+)?$')
+
+# Maximum difference between the acquisition time in the URL and in the
+# name of the downloaded file, in seconds
+TOLERANCE = 5
+
+
+def parse_name(file_name):
+    """Split a product file name into its key and acquisition time.
+
+    Returns None if the name is not the one of an ERS or Envisat product,
+    e.g. for partial downloads (`.part`, `.crdownload`).
+    """
+    match = _NAME.match(file_name)
+    if match is None:
+        return None
+    (mission, product, stage, date, time, _, relative_orbit, orbit,
+     counter, ext) = match.groups()
+    key = (mission, product, stage, relative_orbit, orbit, counter, ext or '')
+    acquired = datetime.strptime(date + time, '%Y%m%d%H%M%S')
+    return key, acquired.timestamp()
+
+
+class ArchiveIndex:
+    """In-memory index of the ERS and Envisat products of a directory.
+
+    The directory is scanned once, then again only when its modification
+    time changes, i.e. when a file has been added, removed or renamed.
+
+    Parameters
+    ----------
+    directory : str
+        Archive directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._mtime = None
+        self._index = {}
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Scan the directory again if it has been modified."""
+        with self._lock:
+            mtime = os.stat(self.directory).st_mtime_ns
+            if mtime == self._mtime:
+                return
+            index = {}
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    parsed = parse_name(entry.name)
+                    if parsed is None:
+                        continue
+                    key, acquired = parsed
+                    index.setdefault(key, []).append((acquired, entry.name))
+            for files in index.values():
+                files.sort()
+            self._index = index
+            self._mtime = mtime
+
+    def candidates(self, file_name, tolerance=TOLERANCE):
+        """Names of the files matching a product acquired within
+        `tolerance` seconds of the one in `file_name`."""
+        parsed = parse_name(file_name)
+        if parsed is None:
+            return []
+        self.refresh()
+        key, acquired = parsed
+        files = self._index.get(key, [])
+        start = bisect_left(files, (acquired - tolerance, ''))
+        end = bisect_right(files, (acquired + tolerance, '\uffff'))
+        return [name for _, name in files[start:end]]
+
+    def find(self, file_name, tolerance=TOLERANCE):
+        """Find the file of a product in the archive.
+
+        Returns the path of the file named `file_name` if it exists, else of
+        the single file with a similar name (see `candidates`), ignoring
+        symbolic links and their targets when there are several. Returns
+        None if there is no such file.
+        """
+        path = os.path.join(self.directory, file_name)
+        if os.path.isfile(path):
+            return path
+        paths = [os.path.join(self.directory, name)
+                 for name in self.candidates(file_name, tolerance)]
+        if len(paths) > 1:
+            links = [p for p in paths if os.path.islink(p)]
+            targets = [os.path.join(self.directory, os.readlink(p))
+                       for p in links]
+            paths = [p for p in paths if p not in links and p not in targets]
+        if len(paths) == 1:
+            return paths[0]
+        return None
@@ -2,18 +2,39 @@
 SQLite dump of the ESA Online Catalogue (http://esar-ds.eo.esa.int/sxcat).
 """
 
+import hashlib
+import json
 import os
 import sqlite3
+import sys
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import lru_cache
+from time import time
 
 import pandas as pd
 import requests
 from appdirs import user_data_dir
-from tqdm import tqdm
+
+from asarapi.transfer import fetch
 
 CATALOG_URL = 'http://data.yannforget.me/asarapi/catalog.db'
 # DATA_DIR = user_data_dir('asarapi')
 DATA_DIR = os.path.expanduser('~/.local/share/asarapi')
 
+# A product as streamed by `iter_query`
+Product = namedtuple('Product', [
+    'id', 'date', 'platform', 'path', 'frame', 'orbit', 'polarisation',
+    'swath', 'url', 'footprint', 'footprint_coverage', 'aoi_coverage'],
+    defaults=(None, None))
+
+_EPOCH = datetime(1970, 1, 1)
+
+# Max. total size of the cached query results, in bytes
+QUERY_CACHE_SIZE = 256 * 1024 ** 2
+
 
 def check_catalog():
     """Check that the catalog is downloaded."""
@@ -21,19 +42,68 @@ def check_catalog():
     return os.path.isfile(expected_path)
 
 
-def download_catalog():
-    """Download `catalog.db`."""
+def _check_sha256(path, sha256):
+    """Raise an IOError if the SHA-256 digest of a file does not match."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    if digest.hexdigest() != sha256.lower():
+        raise IOError('Checksum mismatch for {}.'.format(path))
+
+
+def _check_integrity(path):
+    """Raise an IOError if SQLite reports a corrupted database."""
+    conn = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+    try:
+        result = conn.execute('PRAGMA integrity_check;').fetchone()[0]
+    except sqlite3.DatabaseError as e:
+        result = str(e)
+    finally:
+        conn.close()
+    if result != 'ok':
+        raise IOError('Corrupted database {}: {}'.format(path, result))
+
+
+def download_catalog(url=CATALOG_URL, connections=1, sha256=None,
+                     session=None):
+    """Download `catalog.db`.
+
+    The database is downloaded to a temporary `.part` file, resuming a
+    previously interrupted download if any, and optionally over several
+    parallel connections. It replaces the current catalog with an atomic
+    rename only once it has been verified, by its SHA-256 checksum if
+    given, else with `PRAGMA integrity_check`.
+
+    Parameters
+    ----------
+    url : str, optional
+        URL of the database. Defaults to `CATALOG_URL`.
+    connections : int, optional
+        Number of parallel connections. Defaults to 1.
+    sha256 : str, optional
+        Expected SHA-256 checksum of the database, in hexadecimal.
+    session : requests.Session, optional
+        HTTP session to use.
+    """
     os.makedirs(DATA_DIR, exist_ok=True)
-    r = requests.get(CATALOG_URL, stream=True)
     out_path = os.path.join(DATA_DIR, 'catalog.db')
-    file_size = int(r.headers['Content-Length'])
-    progress = tqdm(total=file_size, unit='b', unit_scale=True)
-    with open(out_path, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024*1024):
-            if chunk:
-                f.write(chunk)
-                progress.update(1024*1024)
-    progress.close()
+    if session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=connections)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+    def verify(path):
+        if sha256:
+            _check_sha256(path, sha256)
+        else:
+            _check_integrity(path)
+
+    fetch(session, url, out_path, connections=connections, verify=verify,
+          progressbar=True)
+    # Connections opened on the previous file must not be reused
+    close()
 
 
 def _check_param(value, possible):
@@ -46,50 +116,577 @@ def _check_param(value, possible):
     return value.lower() in possible
 
 
-def _build_query(relation, area, start, end, platform,
-                 product, orbit, polarisation, limit):
-    sql = ('SELECT id, date, platform, path, frame, orbit, polarisation, swath, url, '
-           'AsText(geom) AS footprint '
-           'FROM products '
-           'WHERE {relation}(geom, GeomFromText("{area}", 4326)) '
-           'AND Area(geom) < 10 '
-           'AND date BETWEEN {start} AND {end} ')
-    sql = sql.format(relation=relation, area=area, start=start, end=end)
-
-    # Product type. Precision Image = IMP ; Single-Look Complex = IMS.
+def _product_type(product):
+    """Product type code. Precision Image = IMP ; Single-Look Complex = IMS."""
     if 'look' in product or 'single' in product or 'complex' in product:
-        sql += 'AND SUBSTR(id, 5, 3) = "IMS" '
-    else:
-        sql += 'AND SUBSTR(id, 5, 3) = "IMP" '
+        return 'IMS'
+    return 'IMP'
+
+
+# Candidate rows from the spatial index, given the search geometry
+_SPATIAL_INDEX = ('products.ROWID IN ('
+                  'SELECT ROWID FROM SpatialIndex '
+                  'WHERE f_table_name = \'products\' '
+                  'AND search_frame = {}) ')
+
 
+@lru_cache(maxsize=None)
+def _build_filter(relation, platform, orbit, polarisation, optimized=False):
+    """Build the WHERE clause shared by all queries.
+
+    The area of interest is expected as the `geom` column of an `aoi`
+    relation, so that its geometry is parsed once per query and reused by
+    both the relation test and the spatial index lookup (see
+    `_SPATIAL_INDEX`). `platform`, `orbit` and `polarisation` are booleans
+    telling whether the filter is set: the values themselves are bound as
+    parameters (see `_filter_params`).
+    On an optimized catalog (see `optimize_catalog`), the indexed
+    `product_type` column and case-normalized values are used instead of
+    `SUBSTR(id, 5, 3)` and `COLLATE NOCASE`.
+    """
+    sql = ('WHERE {relation}(products.geom, aoi.geom) '
+           'AND Area(products.geom) < 10 '
+           'AND date BETWEEN ? AND ? ')
+    sql = sql.format(relation=relation)
+    if optimized:
+        sql += 'AND product_type = ? '
+        collate = ''
+    else:
+        sql += 'AND SUBSTR(id, 5, 3) = ? '
+        collate = ' COLLATE NOCASE'
     if platform:
-        sql += 'AND platform = "{}" COLLATE NOCASE '.format(platform)
+        sql += 'AND platform = ?{} '.format(collate)
     if orbit:
-        sql += 'AND orbit = "{}" COLLATE NOCASE '.format(orbit)
+        sql += 'AND orbit = ?{} '.format(collate)
     if polarisation:
-        sql += 'AND polarisation = "{}" COLLATE NOCASE '.format(polarisation)
-    
-    # Use spatial index
-    sql += """AND products.ROWID IN (
-        SELECT ROWID FROM SpatialIndex
-        WHERE f_table_name = 'products'
-        AND search_frame = GeomFromText("{}")) """.format(area)
-    
-    sql += 'LIMIT {};'.format(limit)
+        sql += 'AND polarisation = ?{} '.format(collate)
+    return sql
+
+
+def _filter_params(start, end, platform, product, orbit, polarisation,
+                   optimized=False):
+    """Parameters bound to the placeholders of `_build_filter`."""
+    params = [start, end, _product_type(product)]
+    for value in (platform, orbit, polarisation):
+        if value:
+            params.append(value.upper() if optimized else value)
+    return params
 
+
+# LIMIT keeps SQLite from flattening the CTE into the join, i.e. the
+# geometry is built once instead of once per candidate row.
+_AOI_CTE = 'WITH aoi AS (SELECT GeomFromText(?, 4326) AS geom LIMIT 1) '
+
+_COLUMNS = 'id, date, platform, path, frame, orbit, polarisation, swath, url'
+
+# SQL expression of the footprint for each output format
+FOOTPRINT_FORMATS = {'wkt': 'AsText({})', 'wkb': 'AsBinary({})', 'none': None}
+
+
+def _check_footprint(footprint):
+    """Check the footprint output format."""
+    if footprint not in FOOTPRINT_FORMATS:
+        raise ValueError('Unknown footprint format: {}. Expected one of: {}.'
+                         .format(footprint, ', '.join(FOOTPRINT_FORMATS)))
+
+
+def _footprint_column(geom, footprint):
+    """Footprint column, if any, to append to the product columns."""
+    expr = FOOTPRINT_FORMATS[footprint]
+    if expr is None:
+        return ''
+    return ', {} AS footprint'.format(expr.format(geom))
+
+
+def _build_select(prefix, coverage, footprint='wkt'):
+    """SELECT clause of the product columns.
+
+    With coverage filtering, the raw geometry and the areas needed to
+    compute the coverage ratios are selected instead of the footprint (see
+    `_build_coverage`).
+    """
+    if any(coverage):
+        return ('SELECT {}{}, products.geom AS geom, '
+                'COALESCE(Area(Intersection(products.geom, aoi.geom)), 0) '
+                'AS overlap, Area(products.geom) AS footprint_area, '
+                'Area(aoi.geom) AS aoi_area ').format(prefix, _COLUMNS)
+    return 'SELECT {}{}{} '.format(
+        prefix, _COLUMNS, _footprint_column('products.geom', footprint))
+
+
+def _build_coverage(sql, prefix, coverage, footprint='wkt'):
+    """Compute coverage ratios and drop rows below the thresholds.
+
+    `coverage` tells whether the footprint and the area coverage thresholds
+    are set. A row is kept if it satisfies at least one of them, as in
+    `asarapi.footprints.filter_coverage`. The footprints of the dropped rows
+    are never serialized.
+    """
+    # OFFSET 0 keeps SQLite from flattening the subquery, which would
+    # compute the intersection once per reference to `overlap`.
+    sql = ('SELECT {prefix}{columns}{footprint}, '
+           'CASE WHEN footprint_area > 0 THEN overlap / footprint_area '
+           'ELSE 0.0 END AS footprint_coverage, '
+           'CASE WHEN aoi_area > 0 THEN overlap / aoi_area '
+           'ELSE 1.0 END AS aoi_coverage '
+           'FROM ({sql}LIMIT -1 OFFSET 0) ').format(
+               prefix=prefix, columns=_COLUMNS,
+               footprint=_footprint_column('geom', footprint), sql=sql)
+    conditions = []
+    if coverage[0]:
+        conditions.append('footprint_coverage >= ?')
+    if coverage[1]:
+        conditions.append('aoi_coverage >= ?')
+    return sql + 'WHERE ' + ' OR '.join(conditions) + ' '
+
+
+def _build_from_aoi(relation, platform, orbit, polarisation, optimized):
+    """FROM and WHERE clauses of the single-area statements."""
+    sql = 'FROM aoi CROSS JOIN products '
+    sql += _build_filter(relation, platform, orbit, polarisation, optimized)
+    # Not correlated with the join: the spatial index is searched once, and
+    # the planner may still drive the query from the attribute indexes of
+    # an optimized catalog.
+    sql += 'AND ' + _SPATIAL_INDEX.format('(SELECT geom FROM aoi)')
     return sql
 
 
-def _connect_db():
+@lru_cache(maxsize=None)
+def _build_query(relation, platform, orbit, polarisation, optimized=False,
+                 coverage=(False, False), paged=False, footprint='wkt'):
+    """SQL statement of `query`.
+
+    Statements are cached by filter combination: the same text is always
+    returned for the same filters, so that SQLite parses and plans it once
+    and the prepared statement is reused from the connection cache.
+    With `paged`, results are sorted by (date, id) and only the rows after
+    a bound (date, id) key are returned, for keyset pagination.
+    """
+    sql = _build_select('', coverage, footprint)
+    sql += _build_from_aoi(relation, platform, orbit, polarisation, optimized)
+    if paged:
+        sql += 'AND (date, id) > (?, ?) '
+    if any(coverage):
+        sql = _build_coverage(sql, '', coverage, footprint)
+    if paged:
+        sql += 'ORDER BY date, id '
+    return _AOI_CTE + sql + 'LIMIT ?;'
+
+
+@lru_cache(maxsize=None)
+def _build_count(relation, platform, orbit, polarisation, optimized=False,
+                 coverage=(False, False)):
+    """SQL statement of `count`."""
+    if any(coverage):
+        sql = _build_select('', coverage)
+        sql += _build_from_aoi(relation, platform, orbit, polarisation,
+                               optimized)
+        sql = 'SELECT COUNT(*) FROM ({});'.format(
+            _build_coverage(sql, '', coverage))
+        return _AOI_CTE + sql
+    sql = _AOI_CTE + 'SELECT COUNT(*) '
+    sql += _build_from_aoi(relation, platform, orbit, polarisation, optimized)
+    return sql + ';'
+
+
+@lru_cache(maxsize=None)
+def _build_query_many(relation, platform, orbit, polarisation,
+                      optimized=False, coverage=(False, False),
+                      footprint='wkt'):
+    """SQL statement of `query_many`, run against the `temp.aois` table."""
+    sql = _build_select('aoi.aoi AS aoi, ', coverage, footprint)
+    sql += 'FROM temp.aois AS aoi CROSS JOIN products NOT INDEXED '
+    # The lookup depends on each area: NOT INDEXED keeps it driving the join
+    # instead of being re-run for every row found through another index.
+    sql += 'ON ' + _SPATIAL_INDEX.format('aoi.geom')
+    sql += _build_filter(relation, platform, orbit, polarisation, optimized)
+    if any(coverage):
+        sql = _build_coverage(sql, 'aoi, ', coverage, footprint)
+    # Apply `limit` to each AOI rather than to the whole result
+    sql = ('SELECT * FROM (SELECT *, ROW_NUMBER() OVER '
+           '(PARTITION BY aoi ORDER BY date, id) AS rank FROM ({})) '
+           'WHERE rank <= ?;').format(sql)
+    return sql
+
+
+# One catalog connection per thread, reused across queries
+_local = threading.local()
+
+# Whether mod_spatialite can be loaded, checked on first use
+_spatialite = None
+
+ENGINES = ['spatialite', 'python']
+
+
+def _open_db(readonly=True):
+    """Open a new connection to `catalog.db`, with spatialite loaded if it
+    is available (see `default_engine`).
+
+    Without the extension, the connection still serves the statements that
+    do not need it, e.g. the product URL lookups of `asarapi.download`.
+    """
     dbpath = os.path.join(DATA_DIR, 'catalog.db')
-    conn = sqlite3.connect(dbpath)
-    conn.enable_load_extension(True)
-    conn.execute('SELECT load_extension("mod_spatialite");')
+    if readonly:
+        conn = sqlite3.connect('file:{}?mode=ro'.format(dbpath), uri=True,
+                               cached_statements=256)
+    else:
+        conn = sqlite3.connect(dbpath, cached_statements=256)
+    if default_engine() == 'spatialite':
+        conn.enable_load_extension(True)
+        conn.execute('SELECT load_extension("mod_spatialite");')
+        conn.enable_load_extension(False)
     return conn
 
 
+def _connect_db():
+    """Get the read-only connection of the current thread.
+
+    The connection is opened (and spatialite loaded, if available) on first
+    use only, then reused by every subsequent call from the same thread and
+    process. It stays open until `close()` is called.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.pid != os.getpid():
+        if getattr(_local, 'pid', None) != os.getpid():
+            # The `connect()` blocks of a parent process are not ours. A
+            # connection closed inside a block is reopened in the same one.
+            _local.depth = 0
+        # Never reuse a connection inherited from a parent process
+        conn = _open_db()
+        _local.conn = conn
+        _local.pid = os.getpid()
+        _local.optimized = _is_optimized(conn)
+    return conn
+
+
+def default_engine():
+    """Query engine used by default: 'spatialite' if the extension can be
+    loaded, else 'python' (see `asarapi.spatial`)."""
+    global _spatialite
+    if _spatialite is None:
+        # Not an extension issue, and not worth pinning the engine for
+        if not check_catalog():
+            raise FileNotFoundError(
+                'Database not found. Run `asarapi sync` first.')
+        conn = sqlite3.connect(':memory:')
+        try:
+            conn.enable_load_extension(True)
+            conn.execute('SELECT load_extension("mod_spatialite");')
+            _spatialite = True
+        except (AttributeError, sqlite3.OperationalError):
+            # No `enable_load_extension`, or no mod_spatialite
+            print('Warning, mod_spatialite cannot be loaded, '
+                  'using the python query engine', file=sys.stderr)
+            _spatialite = False
+        finally:
+            conn.close()
+    return 'spatialite' if _spatialite else 'python'
+
+
+def _check_engine(engine):
+    """Resolve and check the query engine."""
+    engine = engine or default_engine()
+    if engine not in ENGINES:
+        raise ValueError('Unknown query engine: {}. Expected one of: {}.'
+                         .format(engine, ', '.join(ENGINES)))
+    return engine
+
+
+def _is_optimized(conn):
+    """Check whether `optimize_catalog` has been run on the database."""
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(products);')]
+    return 'product_type' in columns
+
+
+def optimize_catalog():
+    """Prepare `catalog.db` for faster attribute filtering.
+
+    Adds a `product_type` column (IMP or IMS) materialized from the product
+    id, normalizes `platform`, `orbit` and `polarisation` to upper case and
+    creates composite indexes on product type, platform and date, so that
+    these filters no longer require scanning every candidate row. This is
+    a one-time operation; queries fall back to the original SQL on catalogs
+    that have not been optimized.
+    """
+    close()
+    conn = _open_db(readonly=False)
+    with conn:
+        if not _is_optimized(conn):
+            conn.execute('ALTER TABLE products ADD COLUMN product_type TEXT;')
+        conn.execute('UPDATE products SET '
+                     'product_type = SUBSTR(id, 5, 3), '
+                     'platform = UPPER(platform), '
+                     'orbit = UPPER(orbit), '
+                     'polarisation = UPPER(polarisation);')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_products_type_platform '
+                     'ON products (product_type, platform, date);')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_products_type_date '
+                     'ON products (product_type, date);')
+    # Statistics let the planner choose between the spatial and B-tree indexes
+    conn.execute('ANALYZE;')
+    conn.close()
+
+
+def close():
+    """Close the catalog connection of the current thread, if any."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == os.getpid():
+        conn.close()
+    _local.conn = None
+
+
+@contextmanager
+def connect():
+    """Share one catalog connection for the duration of a `with` block.
+
+    Every `query` issued inside the block (and every product URL lookup
+    from `asarapi.download`) reuses the same connection, which is closed
+    when the outermost block exits.
+
+    Example
+    -------
+    >>> with connect():
+    ...     for area in areas:
+    ...         products = query(area, start, stop)
+    """
+    conn = _connect_db()
+    _local.depth += 1
+    try:
+        yield conn
+    finally:
+        _local.depth -= 1
+        if _local.depth == 0:
+            close()
+
+
+def _prepare(start, stop, platform, product, orbit, polarisation, contains,
+             min_footprint_coverage=None, min_aoi_coverage=None):
+    """Check search parameters and convert them for the SQL statements.
+
+    Returns the arguments of the statement builders (the shape of the
+    query), the list of filter parameters to bind and the list of coverage
+    thresholds to bind.
+    """
+    # Compatibility with spatialite datatypes
+    start = int(start.timestamp())
+    stop = int(stop.timestamp())
+
+    relation = 'Intersects'
+    if contains:
+        relation = 'Contains'
+
+    # Check parameters
+    _check_param(platform, ['ERS', 'Envisat'])
+    _check_param(orbit, ['Ascending', 'Descending'])
+    _check_param(polarisation, ['VV', 'VH', 'HV', 'HH'])
+
+    _connect_db()
+    optimized = _local.optimized
+    thresholds = [value for value in (min_footprint_coverage, min_aoi_coverage)
+                  if value is not None]
+    coverage = (min_footprint_coverage is not None,
+                min_aoi_coverage is not None)
+    shape = (relation, bool(platform), bool(orbit), bool(polarisation),
+             optimized, coverage)
+    params = _filter_params(start, stop, platform, product.lower(), orbit,
+                            polarisation, optimized)
+    return shape, params, thresholds
+
+
+def _query_cache_path():
+    """Database of the cached query results."""
+    return os.path.join(DATA_DIR, 'query_cache.db')
+
+
+def _catalog_fingerprint():
+    """Identify the current state of `catalog.db` from its size and mtime.
+
+    Every update of the catalog (new download, delta, optimization) rewrites
+    the file and therefore changes the fingerprint.
+    """
+    st = os.stat(os.path.join(DATA_DIR, 'catalog.db'))
+    return '{}-{}'.format(st.st_mtime_ns, st.st_size)
+
+
+def _normalize_area(area):
+    """Canonical representation of a WKT geometry, whatever its vertex
+    order, starting point or formatting."""
+    import shapely
+    return shapely.to_wkb(shapely.normalize(shapely.from_wkt(area)), hex=True)
+
+
+def _open_cache():
+    """Open the database of the cached query results.
+
+    Each result is stored in its own `result_<digest>` table, listed in the
+    `results` table with the catalog fingerprint it was computed on, the
+    time it was last used, its size in memory and the dtypes of its columns.
+    """
+    os.makedirs(DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(_query_cache_path(), timeout=60)
+    # Give the space of the evicted results back to the file system
+    conn.execute('PRAGMA auto_vacuum = FULL;')
+    with conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS results ('
+                     'digest TEXT PRIMARY KEY, fingerprint TEXT, '
+                     'accessed REAL, size INTEGER, dtypes TEXT);')
+    return conn
+
+
+def _drop_results(conn, digests):
+    """Remove cached results."""
+    for digest in digests:
+        conn.execute('DROP TABLE IF EXISTS "result_{}";'.format(digest))
+        conn.execute('DELETE FROM results WHERE digest = ?;', (digest, ))
+
+
+def _evict(conn, fingerprint, max_size):
+    """Remove the results computed on another catalog, then the least
+    recently used ones until `max_size` is reached."""
+    _drop_results(conn, [row[0] for row in conn.execute(
+        'SELECT digest FROM results WHERE fingerprint != ?;',
+        (fingerprint, )).fetchall()])
+    size = 0
+    evicted = []
+    for digest, nbytes in conn.execute('SELECT digest, size FROM results '
+                                       'ORDER BY accessed DESC;').fetchall():
+        size += nbytes
+        if size > max_size:
+            evicted.append(digest)
+    _drop_results(conn, evicted)
+
+
+def _cache_key(engine, start, stop, platform, product, orbit, polarisation,
+               contains, min_footprint_coverage, min_aoi_coverage, limit,
+               footprint):
+    """Identify the parameters of a query, whatever the engine.
+
+    Built from the arguments themselves rather than from the statement of
+    `_prepare`, which requires spatialite. Results of both engines are
+    cached separately, whatever the case of the filters.
+    """
+    platform, orbit, polarisation = (value.upper() if value else None
+                                     for value in (platform, orbit,
+                                                   polarisation))
+    return [engine, int(start.timestamp()), int(stop.timestamp()), platform,
+            product.lower(), orbit, polarisation, contains,
+            min_footprint_coverage, min_aoi_coverage, limit, footprint]
+
+
+def _write_result(conn, table, products):
+    """Write a query result to a new table, in the current transaction."""
+    rows = products.reset_index()
+    for column in rows.columns:
+        if pd.api.types.is_datetime64_any_dtype(rows[column]):
+            rows[column] = rows[column].astype(str)
+    conn.execute(pd.io.sql.get_schema(rows, table, con=conn))
+    conn.executemany('INSERT INTO "{}" VALUES ({});'.format(
+        table, ', '.join('?' * len(rows.columns))),
+        rows.itertuples(index=False, name=None))
+
+
+def _cached(kind, areas, key, run):
+    """Return the cached result of a query, or run and cache it.
+
+    Results are stored in `DATA_DIR/query_cache.db` (see `_open_cache`),
+    keyed by a digest of the query, together with the fingerprint of the
+    catalog, so that they are dropped as soon as the catalog changes. The
+    cache is limited to `QUERY_CACHE_SIZE` bytes, the least recently used
+    results being evicted first.
+    """
+    fingerprint = _catalog_fingerprint()
+    areas = [_normalize_area(area) for area in areas]
+    digest = hashlib.sha256(json.dumps([kind, areas] + key).encode())
+    digest = digest.hexdigest()
+    table = 'result_' + digest
+
+    conn = _open_cache()
+    try:
+        row = conn.execute('SELECT fingerprint, dtypes FROM results '
+                           'WHERE digest = ?;', (digest, )).fetchone()
+        if row is not None and row[0] == fingerprint:
+            try:
+                products = pd.read_sql_query(
+                    'SELECT * FROM "{}";'.format(table), conn,
+                    index_col='id', parse_dates=['date'])
+                # e.g. the resolution of the dates
+                products = products.astype(json.loads(row[1]))
+            except Exception:
+                # e.g. written by an older version: run the query again
+                pass
+            else:
+                with conn:
+                    conn.execute('UPDATE results SET accessed = ? '
+                                 'WHERE digest = ?;', (time(), digest))
+                if 'aoi' in products:
+                    products['aoi'] = [tuple(json.loads(aois))
+                                       for aois in products['aoi']]
+                return products
+
+        products = run()
+        stored = products
+        if 'aoi' in products:
+            stored = products.assign(aoi=[json.dumps([int(i) for i in aois])
+                                          for aois in products['aoi']])
+        size = int(products.memory_usage(deep=True).sum())
+        dtypes = {column: str(dtype)
+                  for column, dtype in products.dtypes.items()}
+        try:
+            with conn:
+                # A single write transaction: other processes caching the
+                # same query wait, and readers never see a partial result
+                conn.execute('BEGIN IMMEDIATE;')
+                _drop_results(conn, [digest])
+                conn.execute('INSERT INTO results VALUES (?, ?, ?, ?, ?);',
+                             (digest, fingerprint, time(), size,
+                              json.dumps(dtypes)))
+                _write_result(conn, table, stored)
+                _evict(conn, fingerprint, QUERY_CACHE_SIZE)
+        except sqlite3.OperationalError:
+            # e.g. locked for too long: the result is just not cached
+            pass
+    finally:
+        conn.close()
+    return products
+
+
+def clear_cache():
+    """Remove all the cached query results."""
+    try:
+        os.remove(_query_cache_path())
+    except FileNotFoundError:
+        pass
+
+
+def count(area, start, stop, platform=None, product='precision', orbit=None,
+          polarisation=None, contains=False, min_footprint_coverage=None,
+          min_aoi_coverage=None, engine=None):
+    """Count the products matching a query, without fetching them.
+
+    Parameters are the same as `query`.
+
+    Returns
+    -------
+    count : int
+        Total number of matching products.
+    """
+    if _check_engine(engine) == 'python':
+        from asarapi import spatial
+        return spatial.count(area, start, stop, platform, product, orbit,
+                             polarisation, contains, min_footprint_coverage,
+                             min_aoi_coverage)
+    shape, params, thresholds = _prepare(
+        start, stop, platform, product, orbit, polarisation, contains,
+        min_footprint_coverage, min_aoi_coverage)
+    conn = _connect_db()
+    return conn.execute(_build_count(*shape),
+                        [area] + params + thresholds).fetchone()[0]
+
+
 def query(area, start, stop, platform=None, product='precision', orbit=None,
-          polarisation=None, contains=False, limit=500):
+          polarisation=None, contains=False, limit=500,
+          min_footprint_coverage=None, min_aoi_coverage=None,
+          footprint='wkt', cache=False, engine=None):
     """Query the SQLite database.
 
     Parameters
@@ -112,34 +709,260 @@ def query(area, start, stop, platform=None, product='precision', orbit=None,
         `area` must contains the product footprint.
     limit : int, optional
         Max. number of results. Defaults to 500.
+    min_footprint_coverage : float, optional
+        Min. fraction of the product footprint inside `area`.
+    min_aoi_coverage : float, optional
+        Min. fraction of `area` covered by the product footprint.
+    footprint : str, optional
+        Format of the `footprint` column: 'wkt' (default), 'wkb', or 'none'
+        to leave out the geometries.
+    cache : bool, optional
+        Reuse the result of an identical previous query, and cache this one.
+        Results are invalidated when the catalog changes.
+    engine : str, optional
+        'spatialite', or 'python' to search an in-memory index of the
+        catalog without the extension (see `asarapi.spatial`). Defaults to
+        spatialite if it can be loaded.
 
     Returns
     -------
     products : dataframe
         Result of the query as a pandas dataframe.
+
+    Notes
+    -----
+    Coverage ratios are computed by spatialite and products are dropped
+    before their footprints are returned. A product is kept if it satisfies
+    at least one of the given thresholds, and the ratios are returned in the
+    `footprint_coverage` and `aoi_coverage` columns.
     """
-    # Compatibility with spatialite datatypes
-    start = int(start.timestamp())
-    stop = int(stop.timestamp())
+    engine = _check_engine(engine)
+    _check_footprint(footprint)
 
-    relation = 'Intersects'
-    if contains:
-        relation = 'Contains'
+    def run():
+        if engine == 'python':
+            from asarapi import spatial
+            return spatial.query(area, start, stop, platform, product, orbit,
+                                 polarisation, contains, limit,
+                                 min_footprint_coverage, min_aoi_coverage,
+                                 footprint)
+        shape, params, thresholds = _prepare(
+            start, stop, platform, product, orbit, polarisation, contains,
+            min_footprint_coverage, min_aoi_coverage)
+        conn = _connect_db()
+        # Fetch one extra row to detect truncated results
+        products = pd.read_sql_query(_build_query(*shape, footprint=footprint),
+                                     conn,
+                                     params=[area] + params + thresholds
+                                     + [limit + 1],
+                                     index_col='id', parse_dates=['date'])
 
-    # Check parameters
-    _check_param(platform, ['ERS', 'Envisat'])
-    _check_param(orbit, ['Ascending', 'Descending'])
-    _check_param(polarisation, ['VV', 'VH', 'HV', 'HH'])
+        if len(products) > limit:
+            total = conn.execute(_build_count(*shape), [area] + params
+                                 + thresholds).fetchone()[0]
+            print('Warning, only the first %d records from %d ones'
+                  % (limit, total), file=sys.stderr)
+            return products.iloc[:limit]
+        else:
+            return products
+
+    if not cache:
+        return run()
+    return _cached('query', [area], _cache_key(
+        engine, start, stop, platform, product, orbit, polarisation,
+        contains, min_footprint_coverage, min_aoi_coverage, limit,
+        footprint), run)
+
+
+def iter_query(area, start, stop, platform=None, product='precision',
+               orbit=None, polarisation=None, contains=False, limit=None,
+               min_footprint_coverage=None, min_aoi_coverage=None,
+               footprint='wkt'):
+    """Stream the results of a query from the SQLite database.
+
+    Products are yielded as they are read from the database cursor, so that
+    the first results are available immediately and memory usage does not
+    grow with the number of results.
 
-    sql = _build_query(relation, area, start, stop, platform, product.lower(),
-                       orbit, polarisation, limit)
+    Parameters are the same as `query`, except:
+
+    limit : int, optional
+        Max. number of results. Defaults to None (no limit).
+
+    Yields
+    ------
+    product : Product
+        Named tuple with the same fields as the columns returned by `query`.
+        `date` is a naive UTC datetime. `footprint` is None with the 'none'
+        format, and the coverage fields are None unless a coverage threshold
+        is set.
+    """
+    shape, params, thresholds = _prepare(
+        start, stop, platform, product, orbit, polarisation, contains,
+        min_footprint_coverage, min_aoi_coverage)
+    _check_footprint(footprint)
     conn = _connect_db()
-    products = pd.read_sql_query(sql, conn, index_col='id', parse_dates=['date'])
-    conn.close()
+    # Fetch one extra row to detect truncated results (-1 means no limit)
+    sql_limit = -1 if limit is None else limit + 1
+    cursor = conn.execute(_build_query(*shape, footprint=footprint),
+                          [area] + params + thresholds + [sql_limit])
+    try:
+        for n, row in enumerate(cursor):
+            if n == limit:
+                total = conn.execute(_build_count(*shape),
+                                     [area] + params + thresholds).fetchone()[0]
+                print('Warning, only the first %d records from %d ones'
+                      % (limit, total), file=sys.stderr)
+                return
+            date = _EPOCH + timedelta(seconds=row[1])
+            if footprint == 'none':
+                yield Product(row[0], date, *row[2:9], None, *row[9:])
+            else:
+                yield Product(row[0], date, *row[2:])
+    finally:
+        cursor.close()
 
-    if len(products) > limit:
-        # this doesn't work because "limit" already be set at "_build_query"
-        print('Warning, only the first %d records from %d ones'%(limit,len(products)))
-        return products.iloc[:limit]
-    else:
+
+def iter_pages(area, start, stop, platform=None, product='precision',
+               orbit=None, polarisation=None, contains=False, page_size=500,
+               min_footprint_coverage=None, min_aoi_coverage=None,
+               footprint='wkt'):
+    """Query the SQLite database page by page.
+
+    Results are sorted by date and product id, and each page is fetched
+    with a keyset condition on the last (date, id) of the previous one, so
+    that arbitrarily large searches are processed with bounded memory and
+    without truncation.
+
+    Parameters are the same as `query`, except:
+
+    page_size : int, optional
+        Max. number of results per page. Defaults to 500.
+
+    Yields
+    ------
+    products : dataframe
+        One page of results as a pandas dataframe.
+    """
+    shape, params, thresholds = _prepare(
+        start, stop, platform, product, orbit, polarisation, contains,
+        min_footprint_coverage, min_aoi_coverage)
+    _check_footprint(footprint)
+    sql = _build_query(*shape, paged=True, footprint=footprint)
+    conn = _connect_db()
+    last_date, last_id = params[0], ''
+    while True:
+        page = pd.read_sql_query(
+            sql, conn, params=[area] + params + [last_date, last_id]
+            + thresholds + [page_size],
+            index_col='id', parse_dates=['date'])
+        if len(page) == 0:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        last_date = (page['date'].iloc[-1] - pd.Timestamp(0)) \
+            // pd.Timedelta(seconds=1)
+        last_id = page.index[-1]
+
+
+def query_many(areas, start, stop, platform=None, product='precision',
+               orbit=None, polarisation=None, contains=False, limit=500,
+               min_footprint_coverage=None, min_aoi_coverage=None,
+               footprint='wkt', cache=False, engine=None):
+    """Query the SQLite database for several areas of interest at once.
+
+    All the areas are loaded into a temporary table and answered by a single
+    statement over one connection, so that the spatial index is scanned in
+    one pass instead of once per area.
+
+    Parameters
+    ----------
+    areas : list of str
+        Areas of interest in WKT.
+    start : datetime
+        Start search date.
+    stop : datetime
+        Stop search date.
+    platform : str
+        Platform short name [ERS, Envisat].
+    product : str
+        Product type [Precision, Single-Look Complex].
+    orbit : str
+        Orbit direction [Ascending, Descending].
+    polarisation : str
+        Polarisation channels [VV, HH].
+    contains : bool, optional
+        Each area must contains the product footprint.
+    limit : int, optional
+        Max. number of results per area. Defaults to 500.
+    min_footprint_coverage : float, optional
+        Min. fraction of the product footprint inside the area.
+    min_aoi_coverage : float, optional
+        Min. fraction of the area covered by the product footprint.
+    footprint : str, optional
+        Format of the `footprint` column: 'wkt' (default), 'wkb' or 'none'.
+    cache : bool, optional
+        Reuse the result of an identical previous query, and cache this one.
+        Results are invalidated when the catalog changes.
+    engine : str, optional
+        Query engine, 'spatialite' or 'python' (see `query`).
+
+    Returns
+    -------
+    products : dataframe
+        Result of the query as a pandas dataframe, with one row per product.
+        The `aoi` column holds the tuple of the indexes (in `areas`) of the
+        areas matched by each product. Coverage ratios, if any, refer to the
+        first of these areas.
+    """
+    engine = _check_engine(engine)
+    _check_footprint(footprint)
+    areas = list(areas)
+
+    def run():
+        if engine == 'python':
+            from asarapi import spatial
+            return spatial.query_many(areas, start, stop, platform, product,
+                                      orbit, polarisation, contains, limit,
+                                      min_footprint_coverage,
+                                      min_aoi_coverage, footprint)
+        shape, params, thresholds = _prepare(
+            start, stop, platform, product, orbit, polarisation, contains,
+            min_footprint_coverage, min_aoi_coverage)
+        sql = _build_query_many(*shape, footprint=footprint)
+        # Fetch one extra row per area to detect truncated results
+        params += thresholds + [limit + 1]
+        conn = _connect_db()
+        with conn:
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS aois '
+                         '(aoi INTEGER PRIMARY KEY, geom BLOB);')
+            conn.executemany('INSERT INTO temp.aois (aoi, geom) '
+                             'VALUES (?, GeomFromText(?, 4326));',
+                             list(enumerate(areas)))
+        try:
+            products = pd.read_sql_query(sql, conn, params=params,
+                                         parse_dates=['date'])
+        finally:
+            with conn:
+                conn.execute('DELETE FROM temp.aois;')
+
+        truncated = products.loc[products['rank'] > limit, 'aoi']
+        for aoi in truncated:
+            print('Warning, only the first %d records for area %d'
+                  % (limit, aoi), file=sys.stderr)
+        products = products[products['rank'] <= limit]
+
+        # Products shared between areas are returned once
+        aois = products.groupby('id', sort=False)['aoi'].agg(tuple)
+        products = products.drop(columns='rank').drop_duplicates('id')
+        products = products.set_index('id')
+        products['aoi'] = aois
         return products
+
+    if not cache:
+        return run()
+    return _cached('query_many', areas, _cache_key(
+        engine, start, stop, platform, product, orbit, polarisation,
+        contains, min_footprint_coverage, min_aoi_coverage, limit,
+        footprint), run)
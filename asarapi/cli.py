@@ -2,13 +2,19 @@
 
 import json
 import os
+from contextlib import nullcontext
 from datetime import datetime
 
 import click
 from shapely.geometry import Point, Polygon, shape
 
-from asarapi.catalog import query, check_catalog, download_catalog
-from asarapi.download import log_in, log_out, request_download
+from asarapi.catalog import (query, query_many, iter_query, check_catalog,
+                             download_catalog, optimize_catalog, connect,
+                             default_engine, ENGINES)
+from asarapi.columnar import export_parquet
+from asarapi.download import log_in, log_out, download_many
+from asarapi.ledger import Ledger
+from asarapi.update import update_catalog
 
 
 def latlon_to_wkt(lat, lon):
@@ -21,14 +27,17 @@ def bounds_to_wkt(max_lat, max_lon, min_lat, min_lon):
                     (min_lon, min_lat)]).wkt
 
 
-def geojson_to_wkt(file_path):
+def geojson_to_wkts(file_path):
     with open(file_path) as f:
         geojson = json.load(f)
     if 'geometry' in geojson:
-        geom = geojson['geometry']
-    else:
-        geom = geojson['features'][0]['geometry']
-    return shape(geom).wkt
+        return [shape(geojson['geometry']).wkt]
+    return [shape(feature['geometry']).wkt
+            for feature in geojson['features']]
+
+
+def geojson_to_wkt(file_path):
+    return geojson_to_wkts(file_path)[0]
 
 
 @click.group()
@@ -38,14 +47,50 @@ def cli():
 
 @click.command()
 @click.option('--overwrite', default=False)
-def sync(overwrite):
+@click.option('--connections', type=click.INT, default=1,
+              help='Number of parallel connections.')
+@click.option('--sha256', type=click.STRING, default=None,
+              help='Expected SHA-256 checksum of the database.')
+@click.option('--update', is_flag=True, default=False,
+              help='Apply the latest changes to an existing database.')
+def sync(overwrite, connections, sha256, update):
     """Download ESA catalogue."""
     if not check_catalog() or overwrite:
-        download_catalog()
+        download_catalog(connections=connections, sha256=sha256)
+    elif update:
+        try:
+            version = update_catalog()
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        click.echo('Database updated to version {}.'.format(version))
     else:
         click.echo('Database already downloaded.')
 
 
+@click.command()
+def optimize():
+    """Index the catalogue for faster searches."""
+    if not check_catalog():
+        raise click.ClickException(
+            'Database not found. Run `asarapi sync` first.')
+    optimize_catalog()
+    click.echo('Database optimized.')
+
+
+@click.command()
+@click.option('--format', 'fmt', type=click.Choice(['parquet']),
+              default='parquet', help='Output format (default = parquet).')
+@click.option('--output', type=click.Path(), required=True,
+              help='Output directory.')
+def export(fmt, output):
+    """Export the catalogue to a columnar dataset."""
+    if not check_catalog():
+        raise click.ClickException(
+            'Database not found. Run `asarapi sync` first.')
+    export_parquet(output)
+    click.echo('Database exported to {}.'.format(output))
+
+
 @click.command()
 @click.option('--geojson', type=click.Path(), default=None,
               help='GeoJSON footprint.')
@@ -67,14 +112,26 @@ def sync(overwrite):
               help='Footprint contained by input geom.')
 @click.option('--limit', type=click.INT, default=500,
               help='Max. number of results.')
+@click.option('--min-footprint-coverage', type=click.FLOAT, default=None,
+              help='Min. fraction of the footprint inside the input geom.')
+@click.option('--min-aoi-coverage', type=click.FLOAT, default=None,
+              help='Min. fraction of the input geom covered by the footprint.')
 @click.option('--output', type=click.Path(), default=None,
               help='Output CSV file.')
+@click.option('--engine', type=click.Choice(ENGINES), default=None,
+              help='Query engine (default = spatialite if available).')
 def search(geojson, start, stop, latlon, bounds, platform, product,
-           polarisation, orbit, contains, limit, output):
+           polarisation, orbit, contains, limit, min_footprint_coverage,
+           min_aoi_coverage, output, engine):
     """Search for ERS and Envisat products."""
-    # Get area of interest in WKT format
+    if not check_catalog():
+        raise click.ClickException(
+            'Database not found. Run `asarapi sync` first.')
+    # Get area(s) of interest in WKT format
+    areas = None
     if geojson:
-        area = geojson_to_wkt(geojson)
+        areas = geojson_to_wkts(geojson)
+        area = areas[0]
     elif latlon:
         area = latlon_to_wkt(*latlon)
     elif bounds:
@@ -88,9 +145,34 @@ def search(geojson, start, stop, latlon, bounds, platform, product,
     start = datetime.strptime(start, '%Y-%m-%d')
     stop = datetime.strptime(stop, '%Y-%m-%d')
 
-    results = query(
-        area=area, start=start, stop=stop, platform=platform, product=product,
-        orbit=orbit, polarisation=polarisation, contains=contains, limit=limit)
+    engine = engine or default_engine()
+    # The python engine has no connection to share nor cursor to stream from
+    with connect() if engine == 'spatialite' else nullcontext():
+        if areas and len(areas) > 1:
+            # Multi-feature GeoJSON: answer all features in one pass
+            results = query_many(
+                areas=areas, start=start, stop=stop, platform=platform,
+                product=product, orbit=orbit, polarisation=polarisation,
+                contains=contains, limit=limit,
+                min_footprint_coverage=min_footprint_coverage,
+                min_aoi_coverage=min_aoi_coverage, engine=engine)
+        elif output or engine == 'python':
+            results = query(
+                area=area, start=start, stop=stop, platform=platform,
+                product=product, orbit=orbit, polarisation=polarisation,
+                contains=contains, limit=limit,
+                min_footprint_coverage=min_footprint_coverage,
+                min_aoi_coverage=min_aoi_coverage, engine=engine)
+        else:
+            # Print product ids as they are read from the database
+            for record in iter_query(
+                    area=area, start=start, stop=stop, platform=platform,
+                    product=product, orbit=orbit, polarisation=polarisation,
+                    contains=contains, limit=limit,
+                    min_footprint_coverage=min_footprint_coverage,
+                    min_aoi_coverage=min_aoi_coverage, footprint='none'):
+                click.echo(record.id)
+            return
 
     if output:
         results.to_csv(output)
@@ -104,18 +186,43 @@ def search(geojson, start, stop, latlon, bounds, platform, product,
 @click.option('-p', '--password', type=click.STRING, help='ESA SSO password.')
 @click.option('-o', '--outputdir', type=click.Path(exists=True),
               default=os.curdir, help='Output directory.')
-@click.argument('product', type=click.STRING)
-def download(product, username, password, outputdir):
-    """Download an ERS or Envisat product."""
+@click.option('-i', '--input', 'input_file', type=click.File('r'),
+              default=None,
+              help='File with one product id per line (- for stdin).')
+@click.option('--workers', type=click.INT, default=4,
+              help='Number of concurrent downloads.')
+@click.option('--connections', type=click.INT, default=1,
+              help='Number of parallel connections per product.')
+@click.option('--ledger', 'ledger_path', type=click.Path(), default=None,
+              help='Download ledger, to skip finished products on restart.')
+@click.option('--min-free-space', type=click.FLOAT, default=0,
+              help='Disk space to leave free, in GB (10^9 bytes).')
+@click.argument('products', type=click.STRING, nargs=-1)
+def download(products, username, password, outputdir, input_file, workers,
+             connections, ledger_path, min_free_space):
+    """Download ERS or Envisat products."""
     if not username or not password:
         raise click.exceptions.BadOptionUsage(
             'ESA SSO credentials are required.')
+    products = list(products)
+    if input_file:
+        products += [line.strip() for line in input_file if line.strip()]
+    if not products:
+        raise click.UsageError('No product to download.')
+    ledger = Ledger(ledger_path) if ledger_path else None
     session = log_in(username, password)
-    request_download(session, product, outputdir)
+    with connect():
+        results = download_many(session, products, outputdir, workers=workers,
+                                connections=connections, ledger=ledger,
+                                min_free_space=int(min_free_space * 1e9))
     log_out(session)
+    if any(isinstance(result, Exception) for result in results.values()):
+        raise click.ClickException('Some products could not be downloaded.')
 
 
 cli.add_command(sync)
+cli.add_command(optimize)
+cli.add_command(export)
 cli.add_command(search)
 cli.add_command(download)
 
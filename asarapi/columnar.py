@@ -0,0 +1,184 @@
+"""Columnar copy of the catalog in Parquet, for analytics-scale scans.
+
+The `products` table is exported to a Parquet dataset partitioned by
+platform and acquisition year (hive layout, e.g. `platform=ERS/year=1998`),
+with the footprints as WKB and their bounding boxes in the `min_x`,
+`min_y`, `max_x` and `max_y` columns. Full-table statistics then only read
+the needed columns, and `query_parquet` answers `query`-style searches by
+pushing the filters on partitions, dates, attributes and bounding boxes down
+to the Parquet reader before testing the exact geometries with shapely.
+
+Requires pyarrow (`pip install asarapi[parquet]`).
+"""
+
+import os
+import shutil
+import sys
+
+import pandas as pd
+import shapely
+
+from asarapi.catalog import (_check_footprint, _check_param, _connect_db,
+                             _product_type)
+
+# Partitioning columns of the dataset
+PARTITIONS = ['platform', 'year']
+
+# Platform, orbit and polarisation are stored in upper case
+_EXPORT = ('SELECT id, date, UPPER(platform) AS platform, path, frame, '
+           'UPPER(orbit) AS orbit, UPPER(polarisation) AS polarisation, '
+           'swath, url, SUBSTR(id, 5, 3) AS product_type, '
+           'CAST(STRFTIME(\'%Y\', date, \'unixepoch\') AS INTEGER) AS year, '
+           'Area(geom) AS area, '
+           'MbrMinX(geom) AS min_x, MbrMinY(geom) AS min_y, '
+           'MbrMaxX(geom) AS max_x, MbrMaxY(geom) AS max_y, '
+           'AsBinary(geom) AS footprint '
+           'FROM products ORDER BY date;')
+
+_COLUMNS = ['id', 'date', 'platform', 'path', 'frame', 'orbit',
+            'polarisation', 'swath', 'url']
+
+
+def _import_pyarrow():
+    """Import pyarrow and its dataset API, which are optional."""
+    try:
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('pyarrow is required for Parquet support. '
+                          'Install it with `pip install asarapi[parquet]`.')
+    return pa, ds, pq
+
+
+def _schemas(pa):
+    """Schema of the Parquet files and of the partitioning."""
+    schema = pa.schema([
+        ('id', pa.string()), ('date', pa.timestamp('s')),
+        ('path', pa.int32()), ('frame', pa.int32()),
+        ('orbit', pa.string()), ('polarisation', pa.string()),
+        ('swath', pa.string()), ('url', pa.string()),
+        ('product_type', pa.string()), ('area', pa.float64()),
+        ('min_x', pa.float64()), ('min_y', pa.float64()),
+        ('max_x', pa.float64()), ('max_y', pa.float64()),
+        ('footprint', pa.binary())])
+    partitioning = pa.schema([('platform', pa.string()),
+                              ('year', pa.int32())])
+    return schema, partitioning
+
+
+def export_parquet(outdir, batch_size=100000):
+    """Export the catalog to a partitioned Parquet dataset.
+
+    The products are streamed from `catalog.db` in date order, in batches
+    of `batch_size` rows, so the whole table never has to fit in memory.
+    Each partition is a single file with one row group per batch, and the
+    partitions already in `outdir` are replaced.
+
+    Parameters
+    ----------
+    outdir : str
+        Output directory of the dataset.
+    batch_size : int, optional
+        Number of products read from the catalog at a time.
+    """
+    pa, ds, pq = _import_pyarrow()
+    schema, _ = _schemas(pa)
+    conn = _connect_db()
+    writers = {}
+    try:
+        for chunk in pd.read_sql_query(_EXPORT, conn, chunksize=batch_size):
+            chunk['date'] = pd.to_datetime(chunk['date'], unit='s')
+            for (platform, year), rows in chunk.groupby(PARTITIONS):
+                writer = writers.get((platform, year))
+                if writer is None:
+                    directory = os.path.join(
+                        outdir, 'platform={}'.format(platform),
+                        'year={}'.format(year))
+                    shutil.rmtree(directory, ignore_errors=True)
+                    os.makedirs(directory)
+                    writer = pq.ParquetWriter(
+                        os.path.join(directory, 'part-0.parquet'), schema)
+                    writers[(platform, year)] = writer
+                writer.write_table(pa.Table.from_pandas(
+                    rows, schema=schema, preserve_index=False))
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+def _build_expression(ds, bounds, start, stop, platform, product, orbit,
+                      polarisation):
+    """Dataset filter with the partition, attribute and bbox predicates."""
+    min_x, min_y, max_x, max_y = bounds
+    # Same conversion as `query`, the dates are stored as UTC
+    start = pd.Timestamp(int(start.timestamp()), unit='s')
+    stop = pd.Timestamp(int(stop.timestamp()), unit='s')
+    expr = ((ds.field('year') >= start.year) &
+            (ds.field('year') <= stop.year) &
+            (ds.field('date') >= start) & (ds.field('date') <= stop) &
+            (ds.field('product_type') == _product_type(product.lower())) &
+            (ds.field('area') < 10) &
+            (ds.field('min_x') <= max_x) & (ds.field('max_x') >= min_x) &
+            (ds.field('min_y') <= max_y) & (ds.field('max_y') >= min_y))
+    for name, value in (('platform', platform), ('orbit', orbit),
+                        ('polarisation', polarisation)):
+        if value:
+            expr &= ds.field(name) == value.upper()
+    return expr
+
+
+def query_parquet(path, area, start, stop, platform=None, product='precision',
+                  orbit=None, polarisation=None, contains=False, limit=500,
+                  footprint='wkt'):
+    """Query a Parquet export of the catalog.
+
+    Parameters are the same as `asarapi.catalog.query`, with `path` the
+    directory written by `export_parquet`. Partitions outside the platform
+    and years of interest are skipped, and the date, attribute and bounding
+    box filters are evaluated by the Parquet reader (row group statistics
+    included). The exact spatial relation is then tested with shapely on
+    the remaining candidates only.
+
+    Returns
+    -------
+    products : dataframe
+        Result of the query as a pandas dataframe, sorted by date, with the
+        same columns as `query`. `platform`, `orbit` and `polarisation` are
+        in upper case.
+    """
+    _check_param(platform, ['ERS', 'Envisat'])
+    _check_param(orbit, ['Ascending', 'Descending'])
+    _check_param(polarisation, ['VV', 'VH', 'HV', 'HH'])
+    _check_footprint(footprint)
+    pa, ds, _ = _import_pyarrow()
+    _, partitioning = _schemas(pa)
+
+    aoi = shapely.from_wkt(area)
+    shapely.prepare(aoi)
+    dataset = ds.dataset(path, format='parquet',
+                         partitioning=ds.partitioning(partitioning,
+                                                      flavor='hive'))
+    expr = _build_expression(ds, aoi.bounds, start, stop, platform, product,
+                             orbit, polarisation)
+    table = dataset.to_table(columns=_COLUMNS + ['footprint'], filter=expr)
+    products = table.to_pandas()
+
+    geoms = shapely.from_wkb(products['footprint'].to_numpy())
+    # Same relation as the `Contains(products.geom, aoi.geom)` of `query`
+    if contains:
+        products = products[shapely.contains(geoms, aoi)]
+    else:
+        products = products[shapely.intersects(geoms, aoi)]
+    products = products.sort_values(['date', 'id']).set_index('id')
+
+    if len(products) > limit:
+        print('Warning, only the first %d records from %d ones'
+              % (limit, len(products)), file=sys.stderr)
+        products = products.iloc[:limit]
+    if footprint == 'wkt':
+        products['footprint'] = shapely.to_wkt(
+            shapely.from_wkb(products['footprint'].to_numpy()))
+    elif footprint == 'none':
+        products = products.drop(columns='footprint')
+    return products
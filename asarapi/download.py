@@ -2,18 +2,27 @@
 product identifier.
 """
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
+from heapq import heappop, heappush
+from itertools import count
+import errno
 import os
+import shutil
 import sqlite3
-from time import sleep
-from urllib.parse import urljoin
+import threading
+from time import time
+from urllib.parse import urljoin, urlparse
 from xml.etree import ElementTree as ET
 
 from bs4 import BeautifulSoup
 import requests
-from tqdm import tqdm
+from requests.adapters import HTTPAdapter
 
 from asarapi.catalog import _connect_db
+from asarapi.ledger import (DONE, DOWNLOADING, FAILED, STAGING,
+                            UNAVAILABLE)
+from asarapi.transfer import _resume_headers, fetch
 
 
 # BASE_URL = 'https://eo-sso-idp.eo.esa.int'
@@ -29,9 +38,53 @@ LOGOUT_URL = 'https://esar-ds.eo.esa.int/oads/Shibboleth.sso/Logout'
 
 # https://esar-ds.eo.esa.int/oads/Shibboleth.sso/Logout
 
+# Fields of the forms auto-submitted during the log-in
+SAML_FIELDS = {'SAMLRequest', 'SAMLResponse', 'RelayState'}
+# Maximum number of forms auto-submitted in a row during the log-in
+MAX_LOGIN_FORMS = 5
+# Maximum time spent waiting for ESA to process the order of a product
+MAX_ORDER_WAIT = 12 * 3600
+# Delay before polling an order again if ESA does not provide one
+DEFAULT_RETRY_AFTER = 60
+# Delay between two checks of the free disk space while waiting for space
+DISK_SPACE_POLL = 60
+# Min. delay between two records of the bytes of a download in progress
+PROGRESS_INTERVAL = 5
+
+
+def _parse_form(html, url):
+    """Get the action URL and the input fields of the first form of a page.
+
+    Returns (None, {}) if the page has no form.
+    """
+    soup = BeautifulSoup(html, 'html.parser')
+    form = soup.find('form')
+    if form is None:
+        return None, {}
+    action = urljoin(url, form.get('action', ''))
+    fields = {field['name']: field.get('value', '')
+              for field in form.find_all('input') if field.get('name')}
+    return action, fields
+
+
+def _submit_saml_forms(session, r):
+    """Submit the SAML forms that a browser would post automatically."""
+    for i in range(MAX_LOGIN_FORMS):
+        url, payload = _parse_form(r.text, r.url)
+        if not SAML_FIELDS.intersection(payload):
+            break
+        r = session.post(url, data=payload)
+    return r
+
 
 def log_in(username, password):
-    """Log-in to ESA Single Sign-In service."""
+    """Log-in to ESA Single Sign-In service.
+
+    Follows the SAML flow of the EO Sign In service: the login form of the
+    identity provider is filled in, keeping its hidden fields (e.g.
+    `sessionDataKey`), then the auto-submitted SAML forms are posted back to
+    the dissemination service, as a browser would do.
+    """
     session = requests.session()
     data_dir = os.path.join(os.path.dirname(__file__))
     session.verify = os.path.join(data_dir, 'certs.pem')
@@ -41,37 +94,32 @@ def log_in(username, password):
     soup = BeautifulSoup(r.text, 'html.parser')
     for link in soup.find_all('a'):
         if 'Login' in link.getText():
-            url = link.attrs['href']
-    print('debuging: BASE_URL, url', BASE_URL, url)
-    login_url = urljoin(BASE_URL, url)
-
-    # payload = {
-    #     'cn': username,
-    #     'password': password,
-    #     'loginFields': 'cn@password',
-    #     'loginMethod': 'umsso',
-    #     'sessionTime': 'oneday',
-    #     'idleTime': 'oneday'
-    # }
-    from uuid import uuid4
-    session_key = uuid4()
-    payload = {
-        'tocommonauth': True,
+            r = session.get(urljoin(r.url, link.attrs['href']))
+            break
+
+    # Identity provider login form, possibly behind a SAML request form
+    r = _submit_saml_forms(session, r)
+    login_url, payload = _parse_form(r.text, r.url)
+    if 'password' not in payload:
+        raise requests.exceptions.ConnectionError('Login form not found.')
+    payload.update({
+        'tocommonauth': 'true',
         'usernameUserInput': username,
         'username': username,
         'password': password,
-        'sessionDataKey': session_key #1457c2d7-1abe-4d8e-afca-3268c17056a0
-    }
-
-    # Login
-    r = session.head(login_url)
-    login_url = r.headers['Location']
-    session.head(login_url)
+    })
     r = session.post(login_url, data=payload)
 
-    if r.status_code != 200 or not 'logged in' in r.text:
+    # Post the SAML response back to the service provider
+    r = _submit_saml_forms(session, r)
+
+    # A successful login ends on the dissemination service, failed ones on
+    # the login form (or an error page) of the identity provider
+    if (r.status_code != 200
+            or urlparse(r.url).netloc != urlparse(BASE_URL).netloc
+            or 'password' in _parse_form(r.text, r.url)[1]):
         raise requests.exceptions.ConnectionError('Login failed.')
-    
+
     return session
 
 
@@ -84,65 +132,346 @@ def log_out(session):
 def _dl_url(product_id):
     """Get download URL from product id."""
     conn = _connect_db()
-    c = conn.cursor()
-    c.execute('SELECT url FROM products WHERE id = ?;', (product_id, ))
-    url = c.fetchone()[0]
-    conn.close()
-    return url
+    c = conn.execute('SELECT url FROM products WHERE id = ?;', (product_id, ))
+    row = c.fetchone()
+    if row is None:
+        raise KeyError('Unknown product {}.'.format(product_id))
+    return row[0]
 
 
-def _dl_file(session, url, outdir, override=False, progressbar=False):
-    """Download file from URL."""
-    r = session.get(url, stream=True)
+def _dl_path(url, outdir, override=False):
+    """Get the output path of a product URL."""
     filename = url.split('/')[-1]
-    if os.path.isfile(os.path.join(outdir, filename)) and not override:
-        raise FileExistsError('%s already exists. Skipping...' % filename)
-    length = int(r.headers['Content-Length'])
-    if progressbar:
-        progress = tqdm(total=length, unit='B', unit_scale=True)
     outfile = os.path.join(outdir, filename)
-    with open(outfile, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024*1024):
-            if chunk:
-                f.write(chunk)
-                if progressbar:
-                    progress.update(1024*1024)
-    if progressbar:
-        progress.close()
+    if os.path.isfile(outfile) and not override:
+        raise FileExistsError('%s already exists. Skipping...' % filename)
+    return outfile
 
 
-def request_download(session, product_id, outdir, override=False,
-                     progressbar=False):
-    """Request download to ESA and interpret the response."""
-    product_url = _dl_url(product_id)
-    r = session.get(product_url, stream=True)
+def _check_order(r):
+    """Interpret the response to a product request.
 
+    Returns the number of seconds before the product is ready, 0 if it can
+    be downloaded now.
+    """
     # Product is not available
     if r.status_code == 404:
         xmlroot = ET.fromstring(r.text)
+        error_msg = r.reason
         for child in xmlroot:
             if 'ResponseMessage' in child.tag:
                 error_msg = child.text
         raise requests.exceptions.InvalidURL(error_msg)
-    
     # Product is available, but ESA must process the order
     if r.status_code == 202:
+        return max(int(r.headers.get('Retry-After', DEFAULT_RETRY_AFTER)), 1)
+    # Resumed download of a product that is already complete
+    if r.status_code == 416:
+        return 0
+    r.raise_for_status()
+    return 0
+
+
+def _order(session, product_url, headers=None):
+    """Order a product, or poll an order that is being processed.
+
+    Returns the number of seconds before the product is ready, and the open
+    streamed response if it can be downloaded now (0 seconds), so that the
+    product is downloaded with the same request.
+    """
+    for attempt in range(2):
+        r = session.get(product_url, headers=headers, stream=True)
+        try:
+            retry_after = _check_order(r)
+        except Exception:
+            r.close()
+            raise
+        if not retry_after:
+            return 0, r
+        r.close()
         # Resend query to get correct "Retry-After" header value
-        r = session.get(product_url, stream=True)
-        retry_after = int(r.headers['Retry-After'])
-        if progressbar:
-            print('The order is being processed by ESA '
-                'and will be ready in {} seconds.'.format(retry_after))
-            progress = tqdm(total=retry_after)
-        for i in range(retry_after):
-            sleep(1)
-            if progressbar:
-                progress.update(1)
-        if progressbar:
-            progress.close()
-        request_download(session, product_id, outdir, override=override,
-                         progressbar=progressbar)
-    
-    # Product is directly available
-    if r.status_code == 200:
-        _dl_file(session, product_url, outdir, progressbar=progressbar)
+    return retry_after, None
+
+
+def _download_size(response):
+    """Number of bytes that a response to a product request will write."""
+    if response.status_code == 416:
+        return 0
+    return int(response.headers.get('Content-Length', 0))
+
+
+class _DiskSpace:
+    """Disk space reserved by the downloads in progress in a directory.
+
+    A download is admitted only while the free space minus the space
+    reserved by the other transfers stays above `min_free_space` bytes.
+    Reservations are released when a transfer ends, which wakes up the
+    downloads waiting for space immediately. The bytes already written by a
+    transfer are counted twice (reserved and no longer free), which errs on
+    the safe side.
+    """
+
+    def __init__(self, directory, min_free_space=0):
+        self.directory = directory
+        self.min_free_space = min_free_space
+        self.reserved = 0
+        self._condition = threading.Condition()
+
+    def _fits(self, nbytes):
+        free = shutil.disk_usage(self.directory).free
+        return free - self.reserved - nbytes >= self.min_free_space
+
+    def reserve(self, nbytes, timeout):
+        """Reserve `nbytes`, waiting at most `timeout` seconds for space.
+
+        Returns False if the space could not be reserved in time.
+        """
+        deadline = time() + timeout
+        with self._condition:
+            while not self._fits(nbytes):
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return False
+                # Also check again from time to time for space freed by
+                # other programs
+                self._condition.wait(min(remaining, DISK_SPACE_POLL))
+            self.reserved += nbytes
+            return True
+
+    def release(self, nbytes):
+        """Release a reservation and wake up the waiting downloads."""
+        with self._condition:
+            self.reserved -= nbytes
+            self._condition.notify_all()
+
+
+def _schedule(session, urls, outdir, workers=4, max_per_host=4,
+              override=False, progressbar=False, max_wait=MAX_ORDER_WAIT,
+              connections=1, ledger=None, min_free_space=0):
+    """Order all the products, then download each one as soon as it is ready.
+
+    Orders being processed by ESA are kept in a priority queue of due times
+    and polled again once their "Retry-After" delay has elapsed, without
+    occupying a worker in between, so that the products which are ready are
+    downloaded meanwhile. An order still not ready after waiting `max_wait`
+    seconds in total fails with a TimeoutError. The state of each product is
+    recorded in `ledger`, if any, with the bytes written so far by the
+    downloads in progress every `PROGRESS_INTERVAL` seconds.
+
+    A transfer only starts once the disk space it needs (its Content-Length)
+    can be reserved while keeping `min_free_space` bytes free, see
+    `_DiskSpace`.
+
+    Returns the path of the downloaded file, or the raised exception, per
+    product id.
+    """
+    hosts = {urlparse(url).netloc for url in urls.values()}
+    semaphores = {host: threading.Semaphore(max_per_host) for host in hosts}
+
+    def record(product_id, state, **kwargs):
+        if ledger is not None:
+            ledger.update(product_id, state, **kwargs)
+
+    space = _DiskSpace(outdir, min_free_space)
+
+    def transfer(product_id, outfile, response, nbytes):
+        record(product_id, DOWNLOADING)
+        last = [time()]
+
+        def report(written):
+            # Bytes of the `.part` file, without a write per chunk
+            if time() - last[0] >= PROGRESS_INTERVAL:
+                last[0] = time()
+                record(product_id, DOWNLOADING, nbytes=written)
+
+        try:
+            # The product is written to a `.part` file, checked against its
+            # Content-Length and renamed, see `asarapi.transfer.fetch`
+            return fetch(session, urls[product_id], outfile,
+                         connections=connections, progressbar=progressbar,
+                         response=response,
+                         callback=report if ledger is not None else None)
+        finally:
+            space.release(nbytes)
+
+    def poll(product_id):
+        product_url = urls[product_id]
+        semaphore = semaphores[urlparse(product_url).netloc]
+        outfile = _dl_path(product_url, outdir, override=override)
+        # Resume a previous partial download with the order request, which
+        # is also the first byte range of a segmented download
+        headers = _resume_headers(outfile)
+        if connections > 1 and not headers:
+            headers = {'Range': 'bytes=0-'}
+        with semaphore:
+            retry_after, response = _order(session, product_url,
+                                           headers=headers)
+            if retry_after:
+                return retry_after, None
+            nbytes = _download_size(response)
+            if space.reserve(nbytes, timeout=0):
+                return 0, transfer(product_id, outfile, response, nbytes)
+            response.close()
+
+        # Wait for the downloads in progress to release disk space without
+        # holding a connection, then request the product again
+        if not space.reserve(nbytes, timeout=max_wait):
+            raise OSError(errno.ENOSPC, 'Not enough disk space to download '
+                          '{} bytes.'.format(nbytes), outdir)
+        with semaphore:
+            try:
+                retry_after, response = _order(session, product_url,
+                                               headers=headers)
+            except Exception:
+                space.release(nbytes)
+                raise
+            if retry_after:
+                space.release(nbytes)
+                return retry_after, None
+            return 0, transfer(product_id, outfile, response, nbytes)
+
+    results = {}
+    waited = dict.fromkeys(urls, 0)
+    order = count()
+    due = []
+    for product_id in urls:
+        heappush(due, (time(), next(order), product_id))
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while due or running:
+            now = time()
+            while due and due[0][0] <= now:
+                _, _, product_id = heappop(due)
+                future = executor.submit(poll, product_id)
+                running[future] = product_id
+            timeout = max(due[0][0] - now, 0) if due else None
+            done, _ = wait(running, timeout=timeout,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                product_id = running.pop(future)
+                try:
+                    retry_after, path = future.result()
+                except Exception as e:
+                    results[product_id] = e
+                    unavailable = isinstance(e, requests.exceptions.InvalidURL)
+                    record(product_id, UNAVAILABLE if unavailable else FAILED,
+                           error=str(e))
+                    print('Failed to download {}: {}'.format(product_id, e))
+                    continue
+                if path is not None:
+                    results[product_id] = path
+                    record(product_id, DONE, path=path,
+                           nbytes=os.path.getsize(path))
+                    print('Downloaded {}.'.format(product_id))
+                elif waited[product_id] + retry_after > max_wait:
+                    results[product_id] = TimeoutError(
+                        'The order of {} was not ready within {} seconds.'
+                        .format(product_id, max_wait))
+                    record(product_id, FAILED, error=str(results[product_id]))
+                    print(results[product_id])
+                else:
+                    record(product_id, STAGING)
+                    waited[product_id] += retry_after
+                    print('The order of {} is being processed by ESA and '
+                          'will be ready in {} seconds.'.format(product_id,
+                                                               retry_after))
+                    heappush(due, (time() + retry_after, next(order),
+                                   product_id))
+    return results
+
+
+def request_download(session, product_id, outdir, override=False,
+                     progressbar=False, max_wait=MAX_ORDER_WAIT,
+                     connections=1):
+    """Request download to ESA and interpret the response.
+
+    Returns the path of the downloaded file.
+    """
+    result = _schedule(session, {product_id: _dl_url(product_id)}, outdir,
+                       workers=1, override=override, progressbar=progressbar,
+                       max_wait=max_wait, connections=connections)[product_id]
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def download_many(session, product_ids, outdir, workers=4, max_per_host=4,
+                  override=False, max_wait=MAX_ORDER_WAIT, connections=1,
+                  ledger=None, min_free_space=0):
+    """Download several products concurrently with a shared session.
+
+    All the products are ordered up front, then downloaded by a pool of
+    `workers` threads sharing the connection pool of the authenticated
+    `session`, with at most `max_per_host` simultaneous requests to the same
+    host. Orders that ESA must process first are polled again at their own
+    "Retry-After" deadline while the products already available are
+    downloaded. A failed product does not stop the others.
+
+    Parameters
+    ----------
+    session : requests.Session
+        Session returned by `log_in`.
+    product_ids : iterable of str
+        Product identifiers.
+    outdir : str
+        Output directory.
+    workers : int, optional
+        Number of concurrent downloads.
+    max_per_host : int, optional
+        Maximum number of concurrent downloads from a single host.
+    override : bool, optional
+        Download products already present in `outdir` again.
+    max_wait : int, optional
+        Maximum time in seconds spent waiting for ESA to process an order.
+    connections : int, optional
+        Number of byte ranges of each product downloaded in parallel. Falls
+        back to a single connection if the server does not accept ranges.
+    ledger : asarapi.ledger.Ledger, optional
+        Ledger recording the state of the downloads. Products it reports as
+        done or unavailable are skipped.
+    min_free_space : int, optional
+        Disk space in bytes left free in `outdir`. Transfers wait until
+        the space they need is available, at most `max_wait` seconds.
+
+    Returns
+    -------
+    results : dict
+        Path of the downloaded file, or the raised exception, per product id.
+    """
+    product_ids = list(product_ids)
+    # Resolve the URLs in the calling thread, which owns the catalog
+    # connection
+    urls = {}
+    results = {}
+    for product_id in product_ids:
+        if ledger is not None and ledger.finished(product_id):
+            results[product_id] = ledger.path(product_id) or \
+                requests.exceptions.InvalidURL(
+                    '{} is not available.'.format(product_id))
+            continue
+        try:
+            urls[product_id] = _dl_url(product_id)
+        except KeyError as e:
+            results[product_id] = e
+    if ledger is not None:
+        ledger.queue(urls)
+
+    adapter = HTTPAdapter(pool_connections=workers,
+                          pool_maxsize=workers * connections)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    start = time()
+    downloaded = _schedule(session, urls, outdir, workers=workers,
+                           max_per_host=max_per_host, override=override,
+                           max_wait=max_wait, connections=connections,
+                           ledger=ledger, min_free_space=min_free_space)
+    elapsed = time() - start
+    results.update(downloaded)
+
+    paths = [path for path in downloaded.values() if isinstance(path, str)]
+    size = sum(os.path.getsize(path) for path in paths)
+    print('Downloaded {} of {} products: {:.1f} MB in {:.0f} s ({:.2f} MB/s).'
+          .format(len(paths), len(product_ids), size / 1e6, elapsed,
+                  size / 1e6 / elapsed if elapsed else 0))
+    return results
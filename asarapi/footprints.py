@@ -0,0 +1,135 @@
+"""Geometric operations on the footprints of query results."""
+
+import numpy as np
+import shapely
+
+from asarapi.catalog import query
+
+
+def _to_geometry(area):
+    """Area of interest as a shapely geometry."""
+    if isinstance(area, str):
+        return shapely.from_wkt(area)
+    return area
+
+
+def to_geometries(footprints):
+    """Parse a column of WKT or WKB footprints into an array of geometries."""
+    footprints = np.asarray(footprints, dtype=object)
+    if len(footprints) and isinstance(footprints[0], (bytes, bytearray)):
+        return shapely.from_wkb(footprints)
+    return shapely.from_wkt(footprints)
+
+
+def to_geodataframe(products):
+    """Convert query results to a GeoDataFrame.
+
+    Parameters
+    ----------
+    products : dataframe
+        Query results with a `footprint` column in WKB or WKT.
+
+    Returns
+    -------
+    products : geodataframe
+        Query results with the footprints as geometry column (EPSG:4326).
+    """
+    try:
+        import geopandas as gpd
+    except ImportError:
+        raise ImportError('geopandas is required to build GeoDataFrames. '
+                          'Install it with `pip install asarapi[geo]`.')
+    geometry = to_geometries(products['footprint'])
+    return gpd.GeoDataFrame(products.drop(columns='footprint'),
+                            geometry=geometry, crs='EPSG:4326')
+
+
+def query_gdf(area, start, stop, **kwargs):
+    """Query the SQLite database and return the results as a GeoDataFrame.
+
+    Footprints are transferred from spatialite as WKB, which is more compact
+    and faster to parse than WKT. Parameters are the same as
+    `asarapi.catalog.query`.
+    """
+    products = query(area, start, stop, footprint='wkb', **kwargs)
+    return to_geodataframe(products)
+
+
+def coverage(products, area):
+    """Compute the overlap between product footprints and an area.
+
+    The area is prepared once and only the footprints that intersect it are
+    intersected, all through vectorized shapely operations.
+
+    Parameters
+    ----------
+    products : dataframe
+        Query results with a `footprint` column in WKT or WKB.
+    area : str or shapely geometry
+        Area of interest (WKT or geometry).
+
+    Returns
+    -------
+    footprint_coverage : array
+        Fraction of each footprint that lies inside the area.
+    aoi_coverage : array
+        Fraction of the area covered by each footprint. For an area without
+        surface (e.g. a point), 1 if the footprint intersects it, else 0.
+    """
+    aoi = _to_geometry(area)
+    shapely.prepare(aoi)
+    footprints = to_geometries(products['footprint'])
+
+    hits = shapely.intersects(aoi, footprints)
+    overlap = np.zeros(len(footprints))
+    overlap[hits] = shapely.area(shapely.intersection(footprints[hits], aoi))
+
+    footprint_area = shapely.area(footprints)
+    footprint_coverage = np.divide(overlap, footprint_area,
+                                   out=np.zeros(len(footprints)),
+                                   where=footprint_area > 0)
+    if aoi.area > 0:
+        aoi_coverage = overlap / aoi.area
+    else:
+        aoi_coverage = hits.astype(float)
+    return footprint_coverage, aoi_coverage
+
+
+def filter_coverage(products, area, min_footprint_coverage=0.2,
+                    min_aoi_coverage=0.5):
+    """Remove products that only cover a small part of an area.
+
+    A product is kept if at least `min_footprint_coverage` of its footprint
+    lies inside the area, or if it covers at least `min_aoi_coverage` of the
+    area. A threshold set to None is not used; with both set to None, all
+    products are kept.
+
+    Parameters
+    ----------
+    products : dataframe
+        Query results with a `footprint` column in WKT or WKB.
+    area : str or shapely geometry
+        Area of interest (WKT or geometry).
+    min_footprint_coverage : float, optional
+        Min. fraction of the footprint inside the area. Defaults to 0.2.
+    min_aoi_coverage : float, optional
+        Min. fraction of the area covered by the footprint. Defaults to 0.5.
+
+    Returns
+    -------
+    products : dataframe
+        Selected products, with the `footprint_coverage` and `aoi_coverage`
+        ratios as additional columns.
+    """
+    footprint_coverage, aoi_coverage = coverage(products, area)
+    products = products.assign(footprint_coverage=footprint_coverage,
+                               aoi_coverage=aoi_coverage)
+    if min_footprint_coverage is None and min_aoi_coverage is None:
+        return products
+
+    keep = np.zeros(len(products), dtype=bool)
+    if min_footprint_coverage is not None:
+        keep |= footprint_coverage >= min_footprint_coverage
+    if min_aoi_coverage is not None:
+        keep |= aoi_coverage >= min_aoi_coverage
+    return products[keep]
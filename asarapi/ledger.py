@@ -0,0 +1,174 @@
+"""Persistent record of the state of product downloads.
+
+The ledger is a small SQLite database, usually stored in the output
+directory, with one row per product: its state, the number of bytes
+downloaded, timings and the last error. It is opened in WAL mode so that
+concurrent workers (threads or processes) can update it while a batch run
+reports its progress, and an interrupted run skips the products that are
+already finished.
+"""
+
+import os
+import sqlite3
+import threading
+from time import time
+
+QUEUED = 'queued'
+STAGING = 'staging'
+DOWNLOADING = 'downloading'
+DONE = 'done'
+UNAVAILABLE = 'unavailable'
+FAILED = 'failed'
+
+STATES = (QUEUED, STAGING, DOWNLOADING, DONE, UNAVAILABLE, FAILED)
+# States of the products that do not have to be downloaded again
+FINISHED = (DONE, UNAVAILABLE)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    id TEXT PRIMARY KEY,
+    url TEXT,
+    state TEXT NOT NULL,
+    path TEXT,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    queued REAL,
+    started REAL,
+    finished REAL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS batches (
+    name TEXT PRIMARY KEY,
+    finished REAL
+);
+"""
+
+
+class Ledger:
+    """Download ledger stored in a SQLite database.
+
+    Each thread uses its own connection, so a single `Ledger` can be shared
+    by the workers of a thread pool.
+
+    Parameters
+    ----------
+    path : str
+        Path to the database, created if it does not exist.
+    """
+
+    def __init__(self, path):
+        self.dbpath = path
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute('PRAGMA journal_mode = WAL;')
+        conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        """Get the connection of the current thread and process."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            # Autocommit: every update is a short transaction of its own
+            conn = sqlite3.connect(self.dbpath, timeout=30,
+                                   isolation_level=None)
+            conn.execute('PRAGMA synchronous = NORMAL;')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        """Close the connection of the current thread."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def queue(self, products):
+        """Add products to the ledger, keeping the state of known ones.
+
+        Parameters
+        ----------
+        products : dict
+            Download URL per product id.
+        """
+        now = time()
+        self._connect().executemany(
+            'INSERT OR IGNORE INTO products (id, url, state, queued) '
+            'VALUES (?, ?, ?, ?);',
+            [(product_id, url, QUEUED, now)
+             for product_id, url in products.items()])
+
+    def update(self, product_id, state, path=None, nbytes=None, error=None):
+        """Record the new state of a product.
+
+        The start time is set when the product first leaves the queue and
+        the end time when it is done, unavailable or failed.
+        """
+        if state not in STATES:
+            raise ValueError('Unknown state {}.'.format(state))
+        now = time()
+        started = now if state in (STAGING, DOWNLOADING) else None
+        finished = now if state in FINISHED + (FAILED, ) else None
+        self._connect().execute(
+            'INSERT INTO products (id, state, queued) VALUES (?, ?, ?) '
+            'ON CONFLICT (id) DO UPDATE SET state = excluded.state;',
+            (product_id, state, now))
+        self._connect().execute(
+            'UPDATE products SET '
+            'path = COALESCE(?, path), '
+            'bytes = COALESCE(?, bytes), '
+            'started = COALESCE(started, ?), '
+            'finished = ?, '
+            'error = ? '
+            'WHERE id = ?;',
+            (path, nbytes, started, finished, error, product_id))
+
+    def state(self, product_id):
+        """State of a product, or None if it is not in the ledger."""
+        row = self._connect().execute(
+            'SELECT state FROM products WHERE id = ?;',
+            (product_id, )).fetchone()
+        return row[0] if row else None
+
+    def path(self, product_id):
+        """Path of a downloaded product, or None."""
+        row = self._connect().execute(
+            'SELECT path FROM products WHERE id = ? AND state = ?;',
+            (product_id, DONE)).fetchone()
+        return row[0] if row else None
+
+    def finished(self, product_id):
+        """Check whether a product does not have to be downloaded again."""
+        return self.state(product_id) in FINISHED
+
+    def summary(self):
+        """Progress of the downloads recorded in the ledger.
+
+        Returns
+        -------
+        summary : dict
+            Number of products per state, total number of bytes downloaded
+            and throughput in bytes per second over the downloading period.
+        """
+        conn = self._connect()
+        summary = dict.fromkeys(STATES, 0)
+        summary.update(conn.execute(
+            'SELECT state, COUNT(*) FROM products GROUP BY state;'))
+        nbytes, start, end = conn.execute(
+            'SELECT SUM(bytes), MIN(started), MAX(finished) FROM products '
+            'WHERE state = ?;', (DONE, )).fetchone()
+        summary['bytes'] = nbytes or 0
+        elapsed = (end - start) if start and end else 0
+        summary['throughput'] = summary['bytes'] / elapsed if elapsed else 0
+        return summary
+
+    def batch_done(self, name):
+        """Check whether a batch of downloads has been completed."""
+        row = self._connect().execute(
+            'SELECT finished FROM batches WHERE name = ?;',
+            (name, )).fetchone()
+        return row is not None
+
+    def mark_batch_done(self, name):
+        """Record that a batch of downloads has been completed."""
+        self._connect().execute(
+            'INSERT OR REPLACE INTO batches (name, finished) VALUES (?, ?);',
+            (name, time()))
@@ -0,0 +1,368 @@
+"""Pure-Python query engine, for systems without mod_spatialite.
+
+Some Python builds cannot load SQLite extensions, and mod_spatialite is not
+installed everywhere. This engine reads `catalog.db` with the standard
+`sqlite3` module only: the footprints are decoded from the spatialite
+geometry blobs, and the products are stored with their bounding boxes in
+`catalog_index.npz` next to the catalog, rebuilt whenever the catalog
+changes. Searches query a shapely STRtree of the bounding boxes, then test
+the exact Intersects/Contains relation on the candidates only.
+
+`asarapi.catalog.query` and friends switch to this engine automatically
+when spatialite cannot be loaded, or with `engine='python'`.
+"""
+
+import os
+import sqlite3
+import struct
+import sys
+import threading
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from asarapi import catalog
+
+INDEX_FILE = 'catalog_index.npz'
+# Version of the layout of the index file, older files are rebuilt
+INDEX_VERSION = 2
+
+# Markers of the spatialite BLOB-Geometry format
+_START = 0x00
+_MBR_END = 0x7C
+_ENTITY = 0x69
+_END = 0xFE
+
+# Number of coordinates per vertex, by thousands of the geometry class
+# (XY, XYZ, XYM, XYZM). These classes are the same as the ISO WKB ones.
+_DIMS = {0: 2, 1: 3, 2: 3, 3: 4}
+
+# Text columns, stored as UTF-8 bytes with a mask of the NULL values
+_TEXT = ['id', 'platform', 'orbit', 'polarisation', 'swath', 'url',
+         'product_type']
+
+_lock = threading.Lock()
+_index = None
+
+
+def _convert(body, offset, order, out):
+    """Append the WKB of the geometry at `offset` of a spatialite blob body
+    to `out`, and return the offset of the end of the geometry."""
+    code, = struct.unpack_from(order + 'i', body, offset)
+    kind, dims = code % 1000, _DIMS.get(code // 1000)
+    if dims is None or not 1 <= kind <= 7:
+        # e.g. compressed geometries (classes 1000000 and above)
+        raise ValueError('Unsupported spatialite geometry class {}.'
+                         .format(code))
+    out += b'\x01' if order == '<' else b'\x00'
+    out += body[offset:offset + 4]
+    offset += 4
+    vertex = 8 * dims
+    if kind == 1:
+        size = vertex
+    elif kind == 2:
+        size = 4 + struct.unpack_from(order + 'i', body, offset)[0] * vertex
+    elif kind == 3:
+        rings, = struct.unpack_from(order + 'i', body, offset)
+        size = 4
+        for _ in range(rings):
+            n, = struct.unpack_from(order + 'i', body, offset + size)
+            size += 4 + n * vertex
+    else:
+        entities, = struct.unpack_from(order + 'i', body, offset)
+        out += body[offset:offset + 4]
+        offset += 4
+        for _ in range(entities):
+            if body[offset] != _ENTITY:
+                raise ValueError('Invalid spatialite geometry blob.')
+            offset = _convert(body, offset + 1, order, out)
+        return offset
+    out += body[offset:offset + size]
+    return offset + size
+
+
+def to_wkb(blob):
+    """Convert a spatialite geometry blob to WKB.
+
+    The blob starts with the byte order, the SRID and the MBR of the
+    geometry (bytes 6 to 38), followed by its class and coordinates laid
+    out as in WKB, except that the items of collections are preceded by an
+    entity marker instead of their byte order.
+    """
+    blob = bytes(blob)
+    if (len(blob) < 44 or blob[0] != _START or blob[38] != _MBR_END
+            or blob[-1] != _END):
+        raise ValueError('Invalid spatialite geometry blob.')
+    order = '<' if blob[1] == 1 else '>'
+    out = bytearray()
+    _convert(blob[39:-1], 0, order, out)
+    return bytes(out)
+
+
+def mbr(blob):
+    """Bounding box (min_x, min_y, max_x, max_y) of a spatialite blob."""
+    order = '<' if blob[1] == 1 else '>'
+    return struct.unpack_from(order + '4d', blob, 6)
+
+
+def _index_path():
+    return os.path.join(catalog.DATA_DIR, INDEX_FILE)
+
+
+def build_index(path=None):
+    """Build the index file of the catalog.
+
+    Parameters
+    ----------
+    path : str, optional
+        Output file. Defaults to `catalog_index.npz` in the data directory.
+    """
+    path = path or _index_path()
+    fingerprint = catalog._catalog_fingerprint()
+    dbpath = os.path.join(catalog.DATA_DIR, 'catalog.db')
+    conn = sqlite3.connect('file:{}?mode=ro'.format(dbpath), uri=True)
+    try:
+        products = pd.read_sql_query(
+            'SELECT id, date, platform, path, frame, orbit, polarisation, '
+            'swath, url, SUBSTR(id, 5, 3) AS product_type, geom '
+            'FROM products;', conn)
+    finally:
+        conn.close()
+
+    footprints = [to_wkb(blob) for blob in products['geom']]
+    sizes = np.fromiter(map(len, footprints), dtype=np.int64,
+                        count=len(footprints))
+    arrays = {
+        'fingerprint': np.array(fingerprint),
+        'version': np.array(INDEX_VERSION),
+        'date': products['date'].to_numpy(np.int64),
+        'path': products['path'].to_numpy(),
+        'frame': products['frame'].to_numpy(),
+        'bounds': np.array([mbr(blob) for blob in products['geom']],
+                           dtype=np.float64).reshape(-1, 4),
+        'area': shapely.area(shapely.from_wkb(footprints)),
+        'offsets': np.concatenate([[0], np.cumsum(sizes)]),
+        'footprints': np.frombuffer(b''.join(footprints), dtype=np.uint8),
+    }
+    for column in _TEXT:
+        arrays[column] = products[column].fillna('').str.encode(
+            'utf-8').to_numpy(np.bytes_)
+        arrays[column + '_null'] = products[column].isna().to_numpy()
+    # Write then rename, so that readers never see a partial file
+    with open(path + '.part', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(path + '.part', path)
+
+
+class FootprintIndex:
+    """Products of the catalog with an STRtree of their bounding boxes.
+
+    Parameters
+    ----------
+    path : str
+        Index file written by `build_index`.
+    """
+
+    def __init__(self, path):
+        with np.load(path) as data:
+            self.fingerprint = str(data['fingerprint'])
+            self.version = int(data['version']) if 'version' in data else 1
+            self.columns = {name: data[name] for name in data.files
+                            if name not in ('fingerprint', 'version')}
+        self.tree = shapely.STRtree(shapely.box(*self.columns['bounds'].T))
+
+    def text(self, name, rows):
+        """Values of a text column for some products, None where NULL as
+        returned by spatialite."""
+        values = np.char.decode(self.columns[name][rows], 'utf-8')
+        values = values.astype(object)
+        values[self.columns[name + '_null'][rows]] = None
+        return values
+
+    def footprints(self, rows):
+        """Footprints of some products as shapely geometries."""
+        return shapely.from_wkb(self.wkb(rows))
+
+    def wkb(self, rows):
+        """Footprints of some products in WKB."""
+        data, offsets = self.columns['footprints'], self.columns['offsets']
+        return [data[offsets[i]:offsets[i + 1]].tobytes() for i in rows]
+
+    def search(self, aoi, start, stop, platform=None, product='precision',
+               orbit=None, polarisation=None, contains=False,
+               min_footprint_coverage=None, min_aoi_coverage=None):
+        """Rows of the products matching a query, sorted by (date, id).
+
+        Returns the row indexes and, if a coverage threshold is set, the
+        footprint and area coverage ratios, else None.
+        """
+        columns = self.columns
+        rows = self.tree.query(aoi)
+        dates = columns['date'][rows]
+        keep = ((columns['area'][rows] < 10) &
+                (dates >= int(start.timestamp())) &
+                (dates <= int(stop.timestamp())) &
+                (columns['product_type'][rows] ==
+                 catalog._product_type(product.lower()).encode()))
+        for name, value in (('platform', platform), ('orbit', orbit),
+                            ('polarisation', polarisation)):
+            if value:
+                keep &= (np.char.upper(columns[name][rows])
+                         == value.upper().encode())
+        rows = rows[keep]
+
+        geoms = self.footprints(rows)
+        # Same relation as the `Contains(products.geom, aoi.geom)` of `query`
+        if contains:
+            keep = shapely.contains(geoms, aoi)
+        else:
+            keep = shapely.intersects(geoms, aoi)
+        rows, geoms = rows[keep], geoms[keep]
+
+        coverage = None
+        if (min_footprint_coverage is not None
+                or min_aoi_coverage is not None):
+            overlap = shapely.area(shapely.intersection(geoms, aoi))
+            footprint_area = columns['area'][rows]
+            aoi_area = shapely.area(aoi)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                footprint_coverage = np.where(
+                    footprint_area > 0, overlap / footprint_area, 0.0)
+                aoi_coverage = (overlap / aoi_area if aoi_area > 0
+                                else np.ones(len(rows)))
+            keep = np.zeros(len(rows), dtype=bool)
+            if min_footprint_coverage is not None:
+                keep |= footprint_coverage >= min_footprint_coverage
+            if min_aoi_coverage is not None:
+                keep |= aoi_coverage >= min_aoi_coverage
+            rows = rows[keep]
+            coverage = footprint_coverage[keep], aoi_coverage[keep]
+
+        order = np.lexsort((columns['id'][rows], columns['date'][rows]))
+        if coverage is not None:
+            coverage = coverage[0][order], coverage[1][order]
+        return rows[order], coverage
+
+    def to_frame(self, rows, coverage=None, footprint='wkt'):
+        """Dataframe of some products, with the columns of `query`."""
+        columns = self.columns
+        products = pd.DataFrame({
+            'date': pd.to_datetime(columns['date'][rows], unit='s'),
+            'platform': self.text('platform', rows),
+            'path': columns['path'][rows],
+            'frame': columns['frame'][rows],
+            'orbit': self.text('orbit', rows),
+            'polarisation': self.text('polarisation', rows),
+            'swath': self.text('swath', rows),
+            'url': self.text('url', rows),
+        }, index=pd.Index(np.char.decode(columns['id'][rows], 'utf-8'),
+                          name='id'))
+        if footprint == 'wkt':
+            products['footprint'] = shapely.to_wkt(self.footprints(rows),
+                                                   rounding_precision=-1)
+        elif footprint == 'wkb':
+            products['footprint'] = self.wkb(rows)
+        if coverage is not None:
+            products['footprint_coverage'] = coverage[0]
+            products['aoi_coverage'] = coverage[1]
+        return products
+
+
+def load_index():
+    """Index of the current catalog, built or rebuilt if needed.
+
+    The index is loaded once per process, and again only when the catalog
+    file changes.
+    """
+    global _index
+    with _lock:
+        fingerprint = catalog._catalog_fingerprint()
+        if _index is not None and _index.fingerprint == fingerprint:
+            return _index
+        path = _index_path()
+        index = FootprintIndex(path) if os.path.isfile(path) else None
+        if (index is None or index.fingerprint != fingerprint
+                or index.version != INDEX_VERSION):
+            build_index(path)
+            index = FootprintIndex(path)
+        _index = index
+        return _index
+
+
+def _check(platform, orbit, polarisation, footprint):
+    catalog._check_param(platform, ['ERS', 'Envisat'])
+    catalog._check_param(orbit, ['Ascending', 'Descending'])
+    catalog._check_param(polarisation, ['VV', 'VH', 'HV', 'HH'])
+    catalog._check_footprint(footprint)
+
+
+def count(area, start, stop, platform=None, product='precision', orbit=None,
+          polarisation=None, contains=False, min_footprint_coverage=None,
+          min_aoi_coverage=None):
+    """Count the products matching a query, as `asarapi.catalog.count`."""
+    _check(platform, orbit, polarisation, 'none')
+    rows, _ = load_index().search(
+        shapely.from_wkt(area), start, stop, platform, product, orbit,
+        polarisation, contains, min_footprint_coverage, min_aoi_coverage)
+    return len(rows)
+
+
+def query(area, start, stop, platform=None, product='precision', orbit=None,
+          polarisation=None, contains=False, limit=500,
+          min_footprint_coverage=None, min_aoi_coverage=None,
+          footprint='wkt'):
+    """Query the catalog, as `asarapi.catalog.query`.
+
+    Products are sorted by date and id. WKT footprints are written by
+    shapely, i.e. with a space between the geometry type and the
+    coordinates, where spatialite has none.
+    """
+    _check(platform, orbit, polarisation, footprint)
+    index = load_index()
+    rows, coverage = index.search(
+        shapely.from_wkt(area), start, stop, platform, product, orbit,
+        polarisation, contains, min_footprint_coverage, min_aoi_coverage)
+    if len(rows) > limit:
+        print('Warning, only the first %d records from %d ones'
+              % (limit, len(rows)), file=sys.stderr)
+        rows = rows[:limit]
+        if coverage is not None:
+            coverage = coverage[0][:limit], coverage[1][:limit]
+    return index.to_frame(rows, coverage, footprint)
+
+
+def query_many(areas, start, stop, platform=None, product='precision',
+               orbit=None, polarisation=None, contains=False, limit=500,
+               min_footprint_coverage=None, min_aoi_coverage=None,
+               footprint='wkt'):
+    """Query the catalog for several areas, as `asarapi.catalog.query_many`.
+    """
+    _check(platform, orbit, polarisation, footprint)
+    index = load_index()
+    matches = {}
+    first = {}
+    for aoi, area in enumerate(areas):
+        rows, coverage = index.search(
+            shapely.from_wkt(area), start, stop, platform, product, orbit,
+            polarisation, contains, min_footprint_coverage,
+            min_aoi_coverage)
+        if len(rows) > limit:
+            print('Warning, only the first %d records for area %d'
+                  % (limit, aoi), file=sys.stderr)
+        for i, row in enumerate(rows[:limit]):
+            if row not in matches:
+                matches[row] = []
+                # Coverage ratios of the first matching area
+                first[row] = (None if coverage is None
+                              else (coverage[0][i], coverage[1][i]))
+            matches[row].append(aoi)
+
+    rows = np.fromiter(matches, dtype=np.int64, count=len(matches))
+    coverage = None
+    if min_footprint_coverage is not None or min_aoi_coverage is not None:
+        coverage = (np.array([first[row][0] for row in rows]),
+                    np.array([first[row][1] for row in rows]))
+    products = index.to_frame(rows, coverage, footprint)
+    products.insert(0, 'aoi', [tuple(matches[row]) for row in rows])
+    return products
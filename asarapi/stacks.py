@@ -0,0 +1,136 @@
+"""Temporal stacks and repeat-pass pairs of products, for InSAR workflows.
+
+Products acquired from the same track (platform, relative orbit, frame and
+orbit direction) form a stack, and interferometric pairs are made of two
+products of a stack separated by at most a given temporal baseline. Pairs
+are found with a binary search in the products sorted by stack and date, so
+that their number, not the square of the number of products, drives the
+cost.
+"""
+
+import numpy as np
+import pandas as pd
+
+from asarapi.catalog import query
+
+# Columns identifying the stack of a product
+STACK_KEYS = ['platform', 'path', 'frame', 'orbit']
+
+# Default max. number of products returned by `query` for `query_pairs`
+MAX_PRODUCTS = 100000
+
+_DAY = 86400
+
+
+def _stack_keys(products):
+    """Stack columns, with the case of platform and orbit normalized as
+    on an optimized catalog."""
+    keys = products[STACK_KEYS].copy()
+    keys['platform'] = keys['platform'].str.upper()
+    keys['orbit'] = keys['orbit'].str.upper()
+    return keys
+
+
+def stacks(products):
+    """Group products by stack.
+
+    Parameters
+    ----------
+    products : dataframe
+        Query results, indexed by product id.
+
+    Returns
+    -------
+    stacks : dict
+        Products sorted by date, per (platform, path, frame, orbit) tuple.
+        Platform and orbit are in upper case.
+    """
+    keys = _stack_keys(products)
+    products = products.assign(**{k: keys[k] for k in STACK_KEYS})
+    products = products.sort_values('date', kind='stable')
+    return {key: group for key, group
+            in products.groupby(STACK_KEYS, sort=True)}
+
+
+def pairs(products, max_baseline, min_baseline=0):
+    """Build the repeat-pass pairs of a set of products.
+
+    Parameters
+    ----------
+    products : dataframe
+        Query results, indexed by product id.
+    max_baseline : float
+        Max. temporal baseline, in days.
+    min_baseline : float, optional
+        Min. temporal baseline, in days. Defaults to 0.
+
+    Returns
+    -------
+    pairs : dataframe
+        One row per pair of products of the same stack, with the ids and
+        dates of the `reference` (oldest) and `secondary` products, their
+        temporal `baseline` in days and the stack columns. Sorted by stack,
+        reference date and secondary date.
+    """
+    keys = _stack_keys(products)
+    stack = keys.groupby(STACK_KEYS, sort=True).ngroup().to_numpy(np.int64)
+    dates = products['date'].to_numpy('datetime64[s]').astype(np.int64)
+
+    # One sorted key per product: stack, then date
+    order = np.lexsort((dates, stack))
+    dates, stack = dates[order], stack[order]
+    offset = dates.min() if len(dates) else 0
+    span = (dates.max() - offset if len(dates) else 0) \
+        + int(max_baseline * _DAY) + 1
+    key = stack * span + (dates - offset)
+
+    # Secondary products of each reference are a contiguous range
+    first = np.maximum(
+        np.arange(1, len(key) + 1),
+        np.searchsorted(key, key + int(np.ceil(min_baseline * _DAY)),
+                        side='left'))
+    last = np.searchsorted(key, key + int(max_baseline * _DAY),
+                           side='right')
+    counts = np.maximum(last - first, 0)
+    reference = np.repeat(np.arange(len(key)), counts)
+    starts = np.cumsum(counts) - counts
+    secondary = (np.arange(counts.sum()) - np.repeat(starts, counts)
+                 + np.repeat(first, counts))
+
+    reference, secondary = order[reference], order[secondary]
+    result = pd.DataFrame({
+        'reference': products.index[reference],
+        'secondary': products.index[secondary],
+        'reference_date': products['date'].to_numpy()[reference],
+        'secondary_date': products['date'].to_numpy()[secondary],
+    })
+    result['baseline'] = ((result['secondary_date']
+                           - result['reference_date'])
+                          / pd.Timedelta(days=1))
+    for column in STACK_KEYS:
+        result[column] = keys[column].to_numpy()[reference]
+    return result
+
+
+def scenes(pairs):
+    """Ids of the products needed by a set of pairs, i.e. the products to
+    download, in order of first use."""
+    ids = pairs[['reference', 'secondary']].to_numpy().ravel()
+    return list(pd.unique(ids))
+
+
+def query_pairs(area, start, stop, max_baseline, min_baseline=0, **kwargs):
+    """Query the catalog and build the repeat-pass pairs of the results.
+
+    Parameters are the same as `asarapi.catalog.query`, except that
+    footprints are not fetched and `limit` defaults to `MAX_PRODUCTS`, plus
+    the `max_baseline` and `min_baseline` of `pairs`, in days.
+
+    Returns
+    -------
+    pairs : dataframe
+        See `pairs`.
+    """
+    kwargs.setdefault('limit', MAX_PRODUCTS)
+    products = query(area, start, stop, footprint='none', **kwargs)
+    return pairs(products, max_baseline, min_baseline)
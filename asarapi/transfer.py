@@ -0,0 +1,380 @@
+"""Resumable and segmented HTTP downloads.
+
+Files are downloaded to a `.part` file next to their destination, which is
+only renamed once complete and verified, so that an interrupted transfer
+never leaves a truncated file in place and can be resumed with HTTP Range
+requests.
+"""
+
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from tqdm import tqdm
+
+# Small enough to lose little data when a connection drops mid-chunk
+CHUNK_SIZE = 64 * 1024
+
+
+def _total_length(response, offset):
+    """Total size of the remote file from the headers of a (partial) GET."""
+    content_range = response.headers.get('Content-Range')
+    if content_range and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        if total != '*':
+            return int(total)
+    length = response.headers.get('Content-Length')
+    if length is None:
+        return None
+    return int(length) + offset
+
+
+class _Progress:
+    """Progress of a download: a progress bar, and a callback with the
+    number of bytes of the file downloaded so far, or both."""
+
+    def __init__(self, total, initial, progressbar=False, callback=None):
+        self.nbytes = initial
+        self.callback = callback
+        self.bar = None
+        if progressbar:
+            self.bar = tqdm(total=total, initial=initial, unit='B',
+                            unit_scale=True)
+        # Updated by the threads of a segmented download
+        self._lock = threading.Lock()
+
+    def update(self, nbytes):
+        with self._lock:
+            self.nbytes += nbytes
+            if self.bar is not None:
+                self.bar.update(nbytes)
+            if self.callback is not None:
+                self.callback(self.nbytes)
+
+    def close(self):
+        if self.bar is not None:
+            self.bar.close()
+
+
+def _write_stream(response, f, progress, limit=None):
+    """Write the body of a streamed response, or its first `limit` bytes.
+
+    Returns the number of bytes actually written.
+    """
+    nbytes = 0
+    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+        if limit is not None:
+            chunk = chunk[:limit - nbytes]
+        if chunk:
+            f.write(chunk)
+            nbytes += len(chunk)
+            if progress is not None:
+                progress.update(len(chunk))
+        if limit is not None and nbytes >= limit:
+            break
+    return nbytes
+
+
+def _discard_segments(part_path):
+    """Remove the `.part` file of a segmented download and its state."""
+    for path in (part_path, part_path + '.json'):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def _resume_headers(path):
+    """Headers of a GET resuming the download of `path` from its `.part`.
+
+    The `.part` file of a segmented download (with a `.part.json` state) is
+    preallocated, so its size says nothing of the bytes downloaded.
+    """
+    part_path = path + '.part'
+    if os.path.isfile(part_path + '.json'):
+        return {}
+    if os.path.isfile(part_path) and os.path.getsize(part_path):
+        return {'Range': 'bytes={}-'.format(os.path.getsize(part_path))}
+    return {}
+
+
+def _fetch_stream(session, url, part_path, progressbar, response=None,
+                  callback=None):
+    """Download over a single connection, resuming from the `.part` file.
+
+    Returns the total size of the file, or None if unknown.
+    """
+    # The holes of a segmented download cannot be resumed from its size
+    if os.path.isfile(part_path + '.json'):
+        _discard_segments(part_path)
+    offset = 0
+    if os.path.isfile(part_path):
+        offset = os.path.getsize(part_path)
+    if response is None:
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        response = session.get(url, headers=headers, stream=True)
+
+    with response as r:
+        if r.status_code == 416:
+            content_range = r.headers.get('Content-Range', '')
+            # Requested range starts at the end of the file: already complete
+            if not content_range or content_range.endswith('/%d' % offset):
+                return offset
+        else:
+            r.raise_for_status()
+            if r.status_code not in (200, 206):
+                raise IOError('Unexpected HTTP status {} for {}.'.format(
+                    r.status_code, url))
+            if r.status_code == 206 and not r.headers.get(
+                    'Content-Range', '').startswith('bytes %d-' % offset):
+                raise IOError('Unexpected byte range for {}.'.format(url))
+            if offset and r.status_code != 206:
+                # Range not honoured by the server: start again from scratch
+                offset = 0
+            total = _total_length(r, offset)
+            progress = None
+            if progressbar or callback is not None:
+                progress = _Progress(total, offset, progressbar, callback)
+            with open(part_path, 'ab' if offset else 'wb') as f:
+                _write_stream(r, f, progress)
+            if progress is not None:
+                progress.close()
+            return total
+
+    # The remote file is smaller than the partial one: start again
+    os.remove(part_path)
+    return _fetch_stream(session, url, part_path, progressbar,
+                         callback=callback)
+
+
+def _pwrite_stream(response, fd, offset, progress, limit=None):
+    """Write the body of a streamed response at `offset` of a shared file,
+    or its first `limit` bytes.
+
+    Returns the number of bytes actually written.
+    """
+    start = offset
+    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+        if limit is not None:
+            chunk = chunk[:limit - (offset - start)]
+        view = memoryview(chunk)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+        if progress is not None:
+            progress.update(len(chunk))
+        if limit is not None and offset - start >= limit:
+            break
+    return offset - start
+
+
+def _probe(session, url):
+    """Get the size of a remote file and whether it accepts byte ranges."""
+    with session.head(url, allow_redirects=True) as r:
+        r.raise_for_status()
+        length = r.headers.get('Content-Length')
+        accept_ranges = r.headers.get('Accept-Ranges', '').lower() == 'bytes'
+    return (int(length) if length is not None else None), accept_ranges
+
+
+def _save_state(state_path, state):
+    """Record the progress of a segmented download."""
+    with open(state_path, 'w') as f:
+        json.dump(state, f)
+
+
+def _first_byte(response):
+    """Offset in the file of the body of a GET, None if it has no body."""
+    if response.status_code == 200:
+        return 0
+    match = re.match(r'bytes (\d+)-',
+                     response.headers.get('Content-Range', ''))
+    if response.status_code == 206 and match:
+        return int(match.group(1))
+    return None
+
+
+def _fetch_segments(session, url, part_path, length, connections,
+                    progressbar, response=None, callback=None):
+    """Download `connections` byte ranges in parallel.
+
+    Each range is written at its offset in the preallocated `.part` file,
+    with `os.pwrite` on a single shared descriptor where available. Completed
+    ranges are recorded in a `.part.json` file so that an
+    interrupted download only fetches the missing ones again. Without this
+    file, a `.part` file holds the beginning of the file written over a
+    single connection, and only the remaining bytes are split into ranges.
+
+    The body of `response`, a GET already sent by the caller, is used for
+    the range it starts with, if any.
+    """
+    state_path = part_path + '.json'
+    state = None
+    if os.path.isfile(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+        if (not os.path.isfile(part_path) or state['length'] != length
+                or state['connections'] != connections):
+            # Holes of other ranges: start again
+            _discard_segments(part_path)
+            state = None
+    if state is None:
+        offset = 0
+        if os.path.isfile(part_path) and os.path.getsize(part_path) <= length:
+            offset = os.path.getsize(part_path)
+        state = {'length': length, 'connections': connections,
+                 'offset': offset, 'done': []}
+        # Recorded before preallocating, so that a `.part` file without
+        # state never has holes
+        _save_state(state_path, state)
+        with open(part_path, 'r+b' if offset else 'wb') as f:
+            f.truncate(length)
+
+    offset = state['offset']
+    bounds = [(offset + i * (length - offset) // connections,
+               offset + (i + 1) * (length - offset) // connections - 1)
+              for i in range(connections)]
+    done = set(state['done'])
+    # Ranges already complete, or empty
+    todo = [i for i in range(connections)
+            if i not in done and bounds[i][0] <= bounds[i][1]]
+
+    progress = None
+    if progressbar or callback is not None:
+        initial = length - sum(bounds[i][1] - bounds[i][0] + 1 for i in todo)
+        progress = _Progress(length, initial, progressbar, callback)
+    lock = threading.Lock()
+
+    first = None
+    if response is not None:
+        start = _first_byte(response)
+        first = next((i for i in todo if bounds[i][0] == start), None)
+
+    def fetch_segment(i):
+        start, end = bounds[i]
+        if i == first:
+            # Read up to the end of the range only
+            r = response
+        else:
+            headers = {'Range': 'bytes={}-{}'.format(start, end)}
+            r = session.get(url, headers=headers, stream=True)
+            r.raise_for_status()
+            if r.status_code != 206:
+                r.close()
+                raise IOError('Byte range request ignored by the server.')
+        with r:
+            if fd is not None:
+                nbytes = _pwrite_stream(r, fd, start, progress,
+                                        limit=end - start + 1)
+            else:
+                with open(part_path, 'r+b') as f:
+                    f.seek(start)
+                    nbytes = _write_stream(r, f, progress,
+                                           limit=end - start + 1)
+        # The `.part` file is preallocated, so its size does not reveal a
+        # range that ended early
+        if nbytes != end - start + 1:
+            raise IOError('Incomplete byte range {}-{} of {}: {} bytes. Run '
+                          'again to resume.'.format(start, end, url, nbytes))
+        with lock:
+            done.add(i)
+            state['done'] = sorted(done)
+            _save_state(state_path, state)
+
+    # os.pwrite is not available on Windows
+    fd = os.open(part_path, os.O_WRONLY) if hasattr(os, 'pwrite') else None
+    try:
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            # Consume the results to raise the first error, if any
+            list(executor.map(fetch_segment, todo))
+    finally:
+        if fd is not None:
+            os.close(fd)
+        if response is not None:
+            response.close()
+    if progress is not None:
+        progress.close()
+    os.remove(state_path)
+
+
+def _probe_response(response):
+    """Get the size of a remote file and whether it accepts byte ranges from
+    the headers of a GET, without reading its body."""
+    accept_ranges = (response.status_code in (206, 416) or
+                     response.headers.get('Accept-Ranges', '').lower()
+                     == 'bytes')
+    # A 206 or 416 answers a Range header: the total is in Content-Range
+    return _total_length(response, 0), accept_ranges
+
+
+def fetch(session, url, path, connections=1, verify=None, progressbar=False,
+          response=None, callback=None):
+    """Download a file with resume support.
+
+    The file is written to `path + '.part'` and moved to `path` with an
+    atomic rename once its size matches the size announced by the server
+    and `verify` succeeded.
+
+    Parameters
+    ----------
+    session : requests.Session
+        HTTP session used for all the requests.
+    url : str
+        URL of the file.
+    path : str
+        Destination path.
+    connections : int, optional
+        Number of byte ranges downloaded in parallel. Falls back to a single
+        connection if the server does not accept byte ranges.
+    verify : callable, optional
+        Called with the path of the complete `.part` file before it is moved
+        to `path`. Must raise an exception if the file is invalid, in which
+        case the `.part` file is removed.
+    progressbar : bool, optional
+        Display a progress bar.
+    response : requests.Response, optional
+        Streamed response to a GET of `url` already sent by the caller, e.g.
+        to check its status, with the headers from `_resume_headers(path)`,
+        or `Range: bytes=0-` for a segmented download. Its headers replace
+        the HEAD request of a segmented download, and its body is written
+        instead of sending a new request: the whole file over a single
+        connection (e.g. if the server ignored the range), else the range
+        it starts with. It is always closed.
+    callback : callable, optional
+        Called with the number of bytes of the file downloaded so far (those
+        of the `.part` file included) after each chunk written.
+
+    Returns
+    -------
+    path : str
+        Destination path.
+    """
+    part_path = path + '.part'
+    length = None
+    if connections > 1:
+        if response is not None:
+            length, accept_ranges = _probe_response(response)
+        else:
+            length, accept_ranges = _probe(session, url)
+        if not accept_ranges or not length:
+            connections = 1
+    if connections > 1:
+        _fetch_segments(session, url, part_path, length, connections,
+                        progressbar, response=response, callback=callback)
+    else:
+        length = _fetch_stream(session, url, part_path, progressbar,
+                               response=response, callback=callback)
+
+    size = os.path.getsize(part_path)
+    if length is not None and size != length:
+        raise IOError('Incomplete download of {}: {} of {} bytes. Run again '
+                      'to resume.'.format(url, size, length))
+    if verify is not None:
+        try:
+            verify(part_path)
+        except Exception:
+            os.remove(part_path)
+            raise
+    os.replace(part_path, path)
+    return path
@@ -0,0 +1,174 @@
+"""Incremental updates of the local catalog.
+
+Instead of downloading the whole `catalog.db` again, `update_catalog` only
+fetches and applies the deltas published after the version of the local
+catalog. A delta is a small SQLite database with:
+
+* a `products` table with the same columns as the catalog, holding the new
+  and changed products;
+* an optional `deleted` table with the `id` of the removed products;
+* a `catalog_meta` table with the `base_version` the delta applies to and
+  the `version` of the catalog once it is applied.
+
+Deltas are listed in a JSON index: a list of objects with the `url`,
+`base_version`, `version` and optional `sha256` of each delta.
+
+The published `catalog.db` records its own version in the same
+`catalog_meta` table. A catalog without it (e.g. one built with
+`to_sqlite.py`) has an unknown version and cannot be updated: replaying the
+deltas from the first one could revert newer products.
+"""
+
+import os
+
+import requests
+
+from asarapi import catalog
+from asarapi.transfer import fetch
+
+DELTA_INDEX_URL = 'http://data.yannforget.me/asarapi/deltas/index.json'
+
+_COLUMNS = ['id', 'date', 'platform', 'path', 'frame', 'orbit',
+            'polarisation', 'swath', 'url', 'geom']
+
+
+def _get_meta(conn, key, schema='main'):
+    """Read a value of the `catalog_meta` table, if any."""
+    tables = conn.execute(
+        'SELECT name FROM {}.sqlite_master WHERE type = \'table\' '
+        'AND name = \'catalog_meta\';'.format(schema)).fetchall()
+    if not tables:
+        return None
+    row = conn.execute('SELECT value FROM {}.catalog_meta WHERE key = ?;'
+                       .format(schema), (key, )).fetchone()
+    return row[0] if row else None
+
+
+def catalog_version(conn=None):
+    """Version of the local catalog, None if it is unknown."""
+    if conn is None:
+        conn = catalog._connect_db()
+    version = _get_meta(conn, 'version')
+    return None if version is None else int(version)
+
+
+def _unknown_version():
+    return ValueError('The version of the local catalog is unknown, so the '
+                      'deltas to apply cannot be determined. Download the '
+                      'whole catalog again with `asarapi sync --overwrite`.')
+
+
+def apply_delta(path):
+    """Apply a delta file to the local catalog.
+
+    New and changed products are upserted into the `products` table and
+    deleted products are removed, in a single transaction. The changes go
+    through the spatialite triggers of the geometry column, so the spatial
+    index is updated row by row instead of being rebuilt.
+
+    Parameters
+    ----------
+    path : str
+        Path to the delta database.
+
+    Returns
+    -------
+    version : int
+        New version of the catalog.
+    """
+    catalog.close()
+    conn = catalog._open_db(readonly=False)
+    try:
+        conn.execute('ATTACH DATABASE ? AS delta;', (path, ))
+        version = catalog_version(conn)
+        if version is None:
+            raise _unknown_version()
+        base_version = int(_get_meta(conn, 'base_version', 'delta'))
+        new_version = int(_get_meta(conn, 'version', 'delta'))
+        if base_version != version:
+            raise ValueError('Delta {} applies to version {}, but the catalog '
+                             'is at version {}.'.format(path, base_version,
+                                                        version))
+
+        columns = ', '.join(_COLUMNS)
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS catalog_meta '
+                         '(key TEXT PRIMARY KEY, value TEXT);')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_products_id '
+                         'ON products (id);')
+            has_deleted = conn.execute(
+                'SELECT name FROM delta.sqlite_master WHERE type = \'table\' '
+                'AND name = \'deleted\';').fetchall()
+            if has_deleted:
+                conn.execute('DELETE FROM main.products WHERE id IN '
+                             '(SELECT id FROM delta.deleted);')
+            # UPDATE then INSERT rather than INSERT OR REPLACE: REPLACE
+            # deletes rows without firing the triggers that maintain the
+            # spatial index.
+            conn.execute('UPDATE main.products SET ({columns}) = '
+                         '(SELECT {columns} FROM delta.products AS d '
+                         'WHERE d.id = products.id) '
+                         'WHERE id IN (SELECT id FROM delta.products);'
+                         .format(columns=columns))
+            conn.execute('INSERT INTO main.products ({columns}) '
+                         'SELECT {columns} FROM delta.products AS d '
+                         'WHERE NOT EXISTS (SELECT 1 FROM main.products AS p '
+                         'WHERE p.id = d.id);'.format(columns=columns))
+            if catalog._is_optimized(conn):
+                conn.execute('UPDATE main.products SET '
+                             'product_type = SUBSTR(id, 5, 3), '
+                             'platform = UPPER(platform), '
+                             'orbit = UPPER(orbit), '
+                             'polarisation = UPPER(polarisation) '
+                             'WHERE id IN (SELECT id FROM delta.products);')
+            conn.execute('INSERT OR REPLACE INTO catalog_meta (key, value) '
+                         'VALUES (\'version\', ?);', (str(new_version), ))
+        conn.execute('DETACH DATABASE delta;')
+    finally:
+        conn.close()
+    return new_version
+
+
+def update_catalog(index_url=DELTA_INDEX_URL, session=None):
+    """Download and apply the deltas published after the local version.
+
+    Parameters
+    ----------
+    index_url : str, optional
+        URL of the JSON index of the deltas.
+    session : requests.Session, optional
+        HTTP session to use.
+
+    Returns
+    -------
+    version : int
+        Version of the catalog after the update.
+
+    Raises
+    ------
+    ValueError
+        If the version of the local catalog is unknown.
+    """
+    version = catalog_version()
+    if version is None:
+        raise _unknown_version()
+    if session is None:
+        session = requests.Session()
+    r = session.get(index_url)
+    r.raise_for_status()
+    deltas = {int(delta['base_version']): delta for delta in r.json()}
+
+    delta_dir = os.path.join(catalog.DATA_DIR, 'deltas')
+    os.makedirs(delta_dir, exist_ok=True)
+    while version in deltas:
+        delta = deltas[version]
+        path = os.path.join(delta_dir, '{}.db'.format(delta['version']))
+
+        def verify(part_path, sha256=delta.get('sha256')):
+            if sha256:
+                catalog._check_sha256(part_path, sha256)
+
+        fetch(session, delta['url'], path, verify=verify)
+        version = apply_delta(path)
+        os.remove(path)
+    return version
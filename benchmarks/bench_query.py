@@ -0,0 +1,95 @@
+"""Microbenchmark of the per-query overhead of `asarapi.catalog`.
+
+Runs the same loop of random point queries twice over one catalog
+connection: once with statements built by string formatting (every query
+is a new statement that SQLite must parse and plan), and once with the
+parameterized statements of `asarapi.catalog._build_query`. Then compares
+the query engines (spatialite and the in-memory index of `asarapi.spatial`)
+on the first `n_engine_queries` areas, through `asarapi.catalog.query`.
+
+Usage: python benchmarks/bench_query.py [n_queries] [n_engine_queries]
+"""
+
+import random
+import sys
+from datetime import datetime
+from time import perf_counter
+
+from asarapi import catalog
+
+
+def legacy_sql(area, start, end, limit):
+    """Statement as built before parameterization."""
+    return ('SELECT id, date, platform, path, frame, orbit, polarisation, '
+            'swath, url, AsText(geom) AS footprint FROM products '
+            'WHERE Intersects(geom, GeomFromText("{area}", 4326)) '
+            'AND Area(geom) < 10 AND date BETWEEN {start} AND {end} '
+            'AND SUBSTR(id, 5, 3) = "IMP" '
+            'AND products.ROWID IN (SELECT ROWID FROM SpatialIndex '
+            'WHERE f_table_name = \'products\' '
+            'AND search_frame = GeomFromText("{area}")) '
+            'LIMIT {limit};').format(area=area, start=start, end=end,
+                                     limit=limit)
+
+
+def run(conn, statements):
+    t0 = perf_counter()
+    for sql, params in statements:
+        conn.execute(sql, params).fetchall()
+    return perf_counter() - t0
+
+
+def compare_engines(points, start, stop):
+    """Run the same queries with each engine.
+
+    Returns the elapsed time and the sets of product ids per engine.
+    """
+    results = {}
+    for engine in catalog.ENGINES:
+        # Warm-up: load the spatialite extension or the index file
+        catalog.query(points[0], start, stop, footprint='none', engine=engine)
+        t0 = perf_counter()
+        ids = [set(catalog.query(p, start, stop, footprint='none',
+                                 engine=engine).index) for p in points]
+        results[engine] = perf_counter() - t0, ids
+    return results
+
+
+def main(n_queries=10000, n_engine_queries=1000):
+    rnd = random.Random(0)
+    start = int(datetime(1995, 1, 1).timestamp())
+    end = int(datetime(2012, 1, 1).timestamp())
+    points = ['POINT({} {})'.format(rnd.uniform(-180, 180),
+                                    rnd.uniform(-60, 80))
+              for _ in range(n_queries)]
+
+    legacy = [(legacy_sql(p, start, end, 500), ()) for p in points]
+    sql = catalog._build_query('Intersects', False, False, False)
+    bound = [(sql, [p] + catalog._filter_params(start, end, None, 'precision',
+                                                None, None) + [500])
+             for p in points]
+
+    with catalog.connect() as conn:
+        # Warm-up: load pages in the OS cache for both runs
+        run(conn, bound[:100])
+        t_legacy = run(conn, legacy)
+        t_bound = run(conn, bound)
+
+    for name, t in (('formatted', t_legacy), ('parameterized', t_bound)):
+        print('{:<14} {:8.3f} s  {:8.1f} us/query'.format(
+            name, t, t / n_queries * 1e6))
+
+    points = points[:n_engine_queries]
+    results = compare_engines(points, datetime(1995, 1, 1),
+                              datetime(2012, 1, 1))
+    for engine, (t, _) in results.items():
+        print('{:<14} {:8.3f} s  {:8.1f} us/query'.format(
+            engine, t, t / len(points) * 1e6))
+    (_, expected), (_, ids) = results.values()
+    mismatches = sum(a != b for a, b in zip(expected, ids))
+    print('{} of {} results differ between engines'.format(
+        mismatches, len(points)))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
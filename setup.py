@@ -35,10 +35,14 @@ setup(
         'click',
         'pandas',
         'tqdm',
-        'shapely',
+        'shapely>=2.0',
         'appdirs',
         'bs4'
     ],
+    extras_require={
+        'geo': ['geopandas'],
+        'parquet': ['pyarrow'],
+    },
     include_package_data=True,
     zip_safe=False,
     entry_points="""
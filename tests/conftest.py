@@ -0,0 +1,154 @@
+"""Local HTTP stand-in for the catalog and ESA dissemination servers."""
+
+import re
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+import pytest
+
+# Body of the 404 answered by ESA for an unavailable product
+NOT_AVAILABLE = (b'<?xml version="1.0"?><Response xmlns="x">'
+                 b'<ResponseCode>404</ResponseCode>'
+                 b'<ResponseMessage>Product not available</ResponseMessage>'
+                 b'</Response>')
+
+
+class StandIn:
+    """State of the stand-in server.
+
+    Attributes
+    ----------
+    files : dict
+        Content of the files, by URL path.
+    plans : dict
+        Answers to the next GETs of a path, consumed one per request:
+        '202:<seconds>' (order being processed), '404' or '200'. Files are
+        served once the plan is exhausted.
+    requests : list
+        (method, path, Range header) of every request received.
+    ranges : bool
+        Whether byte ranges are supported.
+    cut : dict
+        Number of bytes of the body actually sent for the ranges of a path,
+        with a matching Content-Length, as a server ending a segment early.
+    pages : dict
+        HTML pages, by URL path.
+    posts : dict
+        Form handlers, by URL path. Called with the submitted fields, they
+        return the URL the client is redirected to (303 See Other).
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.plans = {}
+        self.requests = []
+        self.ranges = True
+        self.cut = {}
+        self.pages = {}
+        self.posts = {}
+        self.lock = threading.Lock()
+        self.url = None
+
+    def gets(self, path):
+        """Number of GETs received for a path."""
+        return sum(1 for method, p, _ in self.requests
+                   if method == 'GET' and p == path)
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self._serve(head=True)
+
+    def do_GET(self):
+        self._serve()
+
+    def do_POST(self):
+        state = self.server.state
+        length = int(self.headers.get('Content-Length', 0))
+        fields = dict(parse_qsl(self.rfile.read(length).decode()))
+        with state.lock:
+            state.requests.append((self.command, self.path, None))
+        handler = state.posts.get(self.path)
+        if handler is None:
+            return self._send(404, NOT_AVAILABLE)
+        return self._send(303, headers={'Location': handler(fields)})
+
+    def _send(self, status, body=b'', headers=None, head=False):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def _serve(self, head=False):
+        state = self.server.state
+        rng = self.headers.get('Range')
+        with state.lock:
+            state.requests.append((self.command, self.path, rng))
+            plan = state.plans.get(self.path)
+            step = plan.pop(0) if plan and not head else '200'
+        if self.path in state.pages:
+            return self._send(200, state.pages[self.path].encode(),
+                              {'Content-Type': 'text/html'}, head)
+        data = state.files.get(self.path)
+        if step == '404' or data is None:
+            return self._send(404, NOT_AVAILABLE, head=head)
+        if step.startswith('202'):
+            return self._send(202, headers={'Retry-After': step[4:]},
+                              head=head)
+
+        headers = {}
+        if state.ranges:
+            headers['Accept-Ranges'] = 'bytes'
+        if not (rng and state.ranges):
+            return self._send(200, data, headers, head)
+        start, end = re.match(r'bytes=(\d+)-(\d*)', rng).groups()
+        start = int(start)
+        end = int(end) if end else len(data) - 1
+        if start >= len(data):
+            headers['Content-Range'] = 'bytes */{}'.format(len(data))
+            return self._send(416, headers=headers, head=head)
+        headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end,
+                                                           len(data))
+        body = data[start:end + 1]
+        if self.path in state.cut:
+            body = body[:state.cut[self.path]]
+        return self._send(206, body, headers, head)
+
+
+@contextmanager
+def _stand_in():
+    state = StandIn()
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    httpd.daemon_threads = True
+    httpd.state = state
+    state.url = 'http://127.0.0.1:{}'.format(httpd.server_address[1])
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield state
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    """Stand-in server listening on 127.0.0.1."""
+    with _stand_in() as state:
+        yield state
+
+
+@pytest.fixture
+def idp():
+    """Second stand-in server, e.g. the identity provider of a login."""
+    with _stand_in() as state:
+        yield state
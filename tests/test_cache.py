@@ -0,0 +1,122 @@
+"""Query cache of `asarapi.catalog`."""
+
+import os
+
+import pandas as pd
+import pytest
+
+from asarapi import catalog
+
+AREA = 'POLYGON((0 0, 1 0, 1 1, 0 1, 0 0))'
+# Same area, another starting point
+SAME_AREA = 'POLYGON((1 0, 1 1, 0 1, 0 0, 1 0))'
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(catalog, 'DATA_DIR', str(tmp_path))
+    with open(str(tmp_path / 'catalog.db'), 'wb') as f:
+        f.write(b'catalog')
+    return tmp_path
+
+
+def _products(n=2):
+    return pd.DataFrame({
+        'date': pd.to_datetime(['1998-01-01 10:00:00'] * n).as_unit('s'),
+        'path': [1] * n,
+        'footprint': [b'\x01\x02'] * n,
+        'aoi': [(0, 1)] * n,
+    }, index=pd.Index(['id%d' % i for i in range(n)], name='id'))
+
+
+def test_cached(data_dir):
+    runs = []
+
+    def run():
+        runs.append(1)
+        return _products()
+
+    first = catalog._cached('query_many', [AREA], ['key'], run)
+    second = catalog._cached('query_many', [SAME_AREA], ['key'], run)
+    assert len(runs) == 1
+    pd.testing.assert_frame_equal(first, second)
+    catalog._cached('query_many', [AREA], ['other'], run)
+    assert len(runs) == 2
+
+
+def test_cached_catalog_change(data_dir):
+    runs = []
+
+    def run():
+        runs.append(1)
+        return _products()
+
+    catalog._cached('query', [AREA], ['key'], run)
+    with open(str(data_dir / 'catalog.db'), 'ab') as f:
+        f.write(b'update')
+    catalog._cached('query', [AREA], ['key'], run)
+    assert len(runs) == 2
+    conn = catalog._open_cache()
+    assert conn.execute('SELECT COUNT(*) FROM results;').fetchone()[0] == 1
+    conn.close()
+
+
+def test_cached_eviction(data_dir, monkeypatch):
+    size = int(_products().memory_usage(deep=True).sum())
+    monkeypatch.setattr(catalog, 'QUERY_CACHE_SIZE', 2 * size)
+    for key in ['a', 'b', 'c']:
+        catalog._cached('query', [AREA], [key], _products)
+    conn = catalog._open_cache()
+    tables = {row[0] for row in conn.execute(
+        'SELECT name FROM sqlite_master WHERE name GLOB \'result_*\';')}
+    assert conn.execute('SELECT COUNT(*) FROM results;').fetchone()[0] == 2
+    assert len(tables) == 2
+    conn.close()
+    catalog.clear_cache()
+    assert not os.path.exists(str(data_dir / 'query_cache.db'))
+
+
+def test_cached_python_engine(data_dir, monkeypatch):
+    from asarapi import spatial
+    runs = []
+
+    def query(*args):
+        runs.append(args)
+        return _products().drop(columns='aoi')
+
+    monkeypatch.setattr(spatial, 'query', query)
+    start, stop = pd.Timestamp('1998-01-01'), pd.Timestamp('1999-01-01')
+    for _ in range(2):
+        catalog.query(AREA, start, stop, cache=True, engine='python')
+    assert len(runs) == 1
+
+
+def test_default_engine_without_catalog(tmp_path, monkeypatch):
+    monkeypatch.setattr(catalog, 'DATA_DIR', str(tmp_path))
+    monkeypatch.setattr(catalog, '_spatialite', None)
+    with pytest.raises(FileNotFoundError):
+        catalog.default_engine()
+    # Not mistaken for a missing extension
+    assert catalog._spatialite is None
+
+
+def test_cached_concurrent_writes(data_dir):
+    from concurrent.futures import ThreadPoolExecutor
+
+    def cache(_):
+        return catalog._cached('query', [AREA], ['key'], _products)
+
+    # e.g. several tools searching the same region at the same time
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(cache, range(32)))
+    for products in results:
+        pd.testing.assert_frame_equal(products, _products())
+
+
+def test_cache_key_case(data_dir):
+    start, stop = pd.Timestamp('1998-01-01'), pd.Timestamp('1999-01-01')
+    assert catalog._cache_key(
+        'python', start, stop, 'ERS', 'Precision', 'Ascending', 'VV',
+        False, None, None, 500, 'wkt') == catalog._cache_key(
+        'python', start, stop, 'ers', 'precision', 'ascending', 'vv',
+        False, None, None, 500, 'wkt')
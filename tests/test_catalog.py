@@ -0,0 +1,57 @@
+"""Per-thread catalog connection of `asarapi.catalog`."""
+
+import sqlite3
+
+import pytest
+
+from asarapi import catalog
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(catalog, 'DATA_DIR', str(tmp_path))
+    conn = sqlite3.connect(str(tmp_path / 'catalog.db'))
+    conn.execute('CREATE TABLE products (id TEXT PRIMARY KEY, url TEXT);')
+    conn.commit()
+    conn.close()
+    # No spatialite needed to test the connection handling
+    monkeypatch.setattr(catalog, '_open_db', lambda readonly=True:
+                        sqlite3.connect(str(tmp_path / 'catalog.db')))
+    yield tmp_path
+    catalog.close()
+
+
+def test_connect_shares_connection(data_dir):
+    with catalog.connect() as conn:
+        with catalog.connect() as inner:
+            assert inner is conn
+        assert catalog._connect_db() is conn
+    assert catalog._local.conn is None
+
+
+def test_connect_close_inside_block(data_dir):
+    # e.g. `optimize_catalog` or `apply_delta` inside the block
+    with catalog.connect():
+        catalog.close()
+        conn = catalog._connect_db()
+    assert catalog._local.depth == 0
+    assert catalog._local.conn is None
+    with pytest.raises(sqlite3.ProgrammingError):
+        conn.execute('SELECT 1;')
+
+
+def test_connect_without_spatialite(tmp_path, monkeypatch):
+    from asarapi.download import _dl_url
+    monkeypatch.setattr(catalog, 'DATA_DIR', str(tmp_path))
+    # e.g. a node where mod_spatialite cannot be loaded
+    monkeypatch.setattr(catalog, '_spatialite', False)
+    conn = sqlite3.connect(str(tmp_path / 'catalog.db'))
+    conn.execute('CREATE TABLE products (id TEXT PRIMARY KEY, url TEXT);')
+    conn.execute('INSERT INTO products VALUES (\'SAR_IMP_1P\', \'url\');')
+    conn.commit()
+    conn.close()
+    try:
+        with catalog.connect():
+            assert _dl_url('SAR_IMP_1P') == 'url'
+    finally:
+        catalog.close()
@@ -0,0 +1,113 @@
+"""Order scheduling of `download_many` against the local stand-in server."""
+
+import os
+
+import pytest
+import requests
+
+from asarapi import download
+from asarapi.download import _schedule
+from asarapi.ledger import DONE, DOWNLOADING
+
+DATA = bytes(range(256)) * 1024
+
+
+@pytest.fixture
+def session():
+    with requests.Session() as s:
+        yield s
+
+
+def _urls(server, *names):
+    for name in names:
+        server.files['/' + name] = DATA
+    return {name: server.url + '/' + name for name in names}
+
+
+def test_schedule_waits_for_order(server, session, tmp_path):
+    urls = _urls(server, 'a.zip')
+    # `_order` asks twice for the "Retry-After" delay of a staged product
+    server.plans['/a.zip'] = ['202:1', '202:1']
+    results = _schedule(session, urls, str(tmp_path))
+    assert results == {'a.zip': str(tmp_path / 'a.zip')}
+    with open(results['a.zip'], 'rb') as f:
+        assert f.read() == DATA
+    assert server.gets('/a.zip') == 3
+
+
+def test_schedule_unavailable(server, session, tmp_path):
+    urls = _urls(server, 'a.zip')
+    server.plans['/a.zip'] = ['404']
+    results = _schedule(session, urls, str(tmp_path))
+    assert isinstance(results['a.zip'], requests.exceptions.InvalidURL)
+    assert str(results['a.zip']) == 'Product not available'
+    assert not os.listdir(str(tmp_path))
+
+
+def test_schedule_ready_product_not_blocked(server, session, tmp_path):
+    urls = _urls(server, 'a.zip', 'b.zip')
+    server.plans['/a.zip'] = ['202:1', '202:1']
+    results = _schedule(session, urls, str(tmp_path), workers=1)
+    assert results == {name: str(tmp_path / name) for name in urls}
+    paths = [path for method, path, _ in server.requests if method == 'GET']
+    # `b.zip` is downloaded while the order of `a.zip` is processed
+    assert paths == ['/a.zip', '/a.zip', '/b.zip', '/a.zip']
+
+
+def test_schedule_max_wait(server, session, tmp_path):
+    urls = _urls(server, 'a.zip')
+    server.plans['/a.zip'] = ['202:60', '202:60']
+    results = _schedule(session, urls, str(tmp_path), max_wait=30)
+    assert isinstance(results['a.zip'], TimeoutError)
+    assert server.gets('/a.zip') == 2
+
+
+@pytest.mark.parametrize('ranges', [True, False])
+@pytest.mark.parametrize('connections', [1, 4])
+def test_schedule_single_order_request(server, session, tmp_path,
+                                       connections, ranges):
+    server.ranges = ranges
+    urls = _urls(server, 'a.zip', 'b.zip')
+    results = _schedule(session, urls, str(tmp_path),
+                        connections=connections)
+    assert results == {name: str(tmp_path / name) for name in urls}
+    for name in urls:
+        with open(results[name], 'rb') as f:
+            assert f.read() == DATA
+        sent = [(method, rng) for method, path, rng in server.requests
+                if path == '/' + name]
+        # No HEAD request: the order request is also the download, or the
+        # first byte range of the segmented download
+        if connections == 1:
+            assert sent == [('GET', None)]
+        elif ranges:
+            assert sent[0] == ('GET', 'bytes=0-')
+            assert len(sent) == connections
+            assert all(method == 'GET' and rng for method, rng in sent)
+        else:
+            assert sent == [('GET', 'bytes=0-')]
+
+
+class _Recorder:
+    """Ledger keeping the updates in memory."""
+
+    def __init__(self):
+        self.updates = []
+
+    def update(self, product_id, state, **kwargs):
+        self.updates.append((product_id, state, kwargs.get('nbytes')))
+
+
+@pytest.mark.parametrize('connections', [1, 4])
+def test_schedule_reports_partial_bytes(server, session, tmp_path,
+                                        monkeypatch, connections):
+    monkeypatch.setattr(download, 'PROGRESS_INTERVAL', 0)
+    urls = _urls(server, 'a.zip')
+    ledger = _Recorder()
+    _schedule(session, urls, str(tmp_path), connections=connections,
+              ledger=ledger)
+    partial = [nbytes for _, state, nbytes in ledger.updates
+               if state == DOWNLOADING and nbytes is not None]
+    assert partial and partial == sorted(partial)
+    assert partial[-1] == len(DATA)
+    assert ledger.updates[-1] == ('a.zip', DONE, len(DATA))
@@ -0,0 +1,64 @@
+"""SAML log-in flow of `asarapi.download.log_in` against two stand-in
+servers, the dissemination service and the identity provider."""
+
+import pytest
+import requests
+
+from asarapi import download
+
+FORM = '<form action="{}" method="post">{}</form>'
+INPUT = '<input type="{}" name="{}" value="{}"/>'
+
+
+@pytest.fixture
+def flow(server, idp, monkeypatch):
+    monkeypatch.setattr(download, 'BASE_URL', server.url)
+    monkeypatch.setattr(download, 'ADMIN_URL',
+                        server.url + '/oads/access/login')
+    submitted = []
+
+    def log_in(fields):
+        submitted.append(fields)
+        if fields.get('password') == 'secret':
+            return idp.url + '/idp/saml'
+        return idp.url + '/idp/form'
+
+    server.pages['/oads/access/login'] = (
+        '<a href="/oads/access/saml">Login</a>')
+    server.pages['/oads/access/saml'] = FORM.format(
+        idp.url + '/idp/sso', INPUT.format('hidden', 'SAMLRequest', 'req'))
+    idp.posts['/idp/sso'] = lambda fields: idp.url + '/idp/form'
+    idp.pages['/idp/form'] = FORM.format('/idp/commonauth', ''.join([
+        INPUT.format('hidden', 'sessionDataKey', 'key'),
+        INPUT.format('text', 'username', ''),
+        INPUT.format('password', 'password', '')]))
+    idp.posts['/idp/commonauth'] = log_in
+    idp.pages['/idp/saml'] = FORM.format(server.url + '/oads/acs', ''.join([
+        INPUT.format('hidden', 'SAMLResponse', 'ok'),
+        INPUT.format('hidden', 'RelayState', 'state')]))
+    server.posts['/oads/acs'] = lambda fields: server.url + '/oads/access/'
+    server.pages['/oads/access/'] = '<p>Welcome</p>'
+    return submitted
+
+
+def test_log_in(flow, server):
+    session = download.log_in('user', 'secret')
+    session.close()
+    # Hidden fields of the login form are kept
+    assert flow == [{'sessionDataKey': 'key', 'username': 'user',
+                     'usernameUserInput': 'user', 'password': 'secret',
+                     'tocommonauth': 'true'}]
+    assert ('POST', '/oads/acs', None) in server.requests
+
+
+def test_log_in_wrong_password(flow):
+    # Back to the login form of the identity provider
+    with pytest.raises(requests.exceptions.ConnectionError):
+        download.log_in('user', 'wrong')
+
+
+def test_log_in_identity_provider_error(flow, idp):
+    idp.posts['/idp/commonauth'] = lambda fields: idp.url + '/idp/error'
+    idp.pages['/idp/error'] = '<p>Authentication error</p>'
+    with pytest.raises(requests.exceptions.ConnectionError):
+        download.log_in('user', 'secret')
@@ -0,0 +1,145 @@
+"""Pure-Python query engine of `asarapi.spatial`, on a catalog whose
+spatialite geometry blobs are written by the tests."""
+
+import sqlite3
+import struct
+from datetime import datetime
+
+import pandas as pd
+import pytest
+import shapely
+
+from asarapi import catalog, spatial
+
+AREA = 'POLYGON((0 0, 4 0, 4 4, 0 4, 0 0))'
+
+PRODUCTS = [
+    # id, date, platform, orbit, polarisation, swath, footprint
+    ('SAR_IMP_1PNESA19950101_000000_A', '1995-01-01', 'ERS', 'Ascending',
+     'VV', 'IS2', 'POLYGON((1 1, 2 1, 2 2, 1 2, 1 1))'),
+    ('SAR_IMP_1PNESA19960101_000000_B', '1996-01-01', 'ERS', 'Descending',
+     None, None, 'POLYGON((3 3, 6 3, 6 6, 3 6, 3 3))'),
+    ('ASA_IMP_1PNESA20040101_000000_C', '2004-01-01', 'Envisat',
+     'Ascending', 'HH', 'IS2', 'MULTIPOLYGON(((-1 -1, 0.5 -1, 0.5 0.5, '
+     '-1 0.5, -1 -1)), ((8 8, 9 8, 9 9, 8 9, 8 8)))'),
+    ('SAR_IMS_1PNESA19950101_000000_D', '1995-01-01', 'ERS', 'Ascending',
+     'VV', 'IS2', 'POLYGON((1 1, 2 1, 2 2, 1 2, 1 1))'),
+    ('SAR_IMP_1PNESA19970101_000000_E', '1997-01-01', 'ERS', 'Ascending',
+     'VV', 'IS2', 'POLYGON((10 10, 11 10, 11 11, 10 11, 10 10))'),
+]
+
+
+def _blob(geom, srid=4326):
+    """Spatialite geometry blob of a 2D shapely geometry."""
+    header = (b'\x00\x01' + struct.pack('<i4d', srid, *geom.bounds)
+              + b'\x7c')
+    wkb = shapely.to_wkb(geom, byte_order=1)
+    if geom.geom_type.startswith('Multi'):
+        # Items start with an entity marker instead of their byte order
+        body = wkb[1:9] + b''.join(
+            b'\x69' + shapely.to_wkb(part, byte_order=1)[1:]
+            for part in geom.geoms)
+    else:
+        body = wkb[1:]
+    return header + body + b'\xfe'
+
+
+@pytest.mark.parametrize('wkt', [
+    'POINT(1 2)',
+    'LINESTRING(0 0, 1 1, 2 0)',
+    'POLYGON((0 0, 4 0, 4 4, 0 4, 0 0), (1 1, 2 1, 2 2, 1 1))',
+    PRODUCTS[2][-1],
+])
+def test_to_wkb(wkt):
+    geom = shapely.from_wkt(wkt)
+    blob = _blob(geom)
+    assert shapely.from_wkb(spatial.to_wkb(blob)).equals(geom)
+    assert spatial.mbr(blob) == geom.bounds
+
+
+def test_to_wkb_invalid():
+    blob = _blob(shapely.from_wkt('POINT(1 2)'))
+    with pytest.raises(ValueError):
+        spatial.to_wkb(blob[:-1] + b'\x00')
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(catalog, 'DATA_DIR', str(tmp_path))
+    monkeypatch.setattr(spatial, '_index', None)
+    conn = sqlite3.connect(str(tmp_path / 'catalog.db'))
+    conn.execute('CREATE TABLE products (id TEXT PRIMARY KEY, '
+                 'date INTEGER, platform TEXT, path INTEGER, frame INTEGER, '
+                 'orbit TEXT, polarisation TEXT, swath TEXT, url TEXT, '
+                 'geom BLOB);')
+    for pid, date, platform, orbit, polarisation, swath, wkt in PRODUCTS:
+        conn.execute('INSERT INTO products VALUES '
+                     '(?, ?, ?, 1, 2, ?, ?, ?, ?, ?);',
+                     (pid, int(pd.Timestamp(date).timestamp()), platform,
+                      orbit, polarisation, swath, 'http://x/' + pid,
+                      _blob(shapely.from_wkt(wkt))))
+    conn.commit()
+    conn.close()
+    return tmp_path
+
+
+def _ids(products):
+    return [pid[-1] for pid in products.index]
+
+
+def test_query(data_dir):
+    products = spatial.query(AREA, datetime(1990, 1, 1), datetime(2010, 1, 1))
+    # Sorted by date, precision images only
+    assert _ids(products) == ['A', 'B', 'C']
+    assert list(products.columns) == [
+        'date', 'platform', 'path', 'frame', 'orbit', 'polarisation',
+        'swath', 'url', 'footprint']
+    # NULL values are returned as spatialite does, not as ''
+    assert products['swath'].isna().tolist() == [False, True, False]
+    assert products['polarisation'].isna().tolist() == [False, True, False]
+    assert (shapely.from_wkt(products['footprint'].iloc[2])
+            .equals(shapely.from_wkt(PRODUCTS[2][-1])))
+
+
+def test_query_filters(data_dir):
+    start, stop = datetime(1990, 1, 1), datetime(2010, 1, 1)
+    # Footprints containing the area
+    inside = 'POLYGON((1.2 1.2, 1.8 1.2, 1.8 1.8, 1.2 1.8, 1.2 1.2))'
+    assert _ids(spatial.query(inside, start, stop, contains=True)) == ['A']
+    assert _ids(spatial.query(AREA, start, stop, platform='envisat')) == [
+        'C']
+    assert _ids(spatial.query(AREA, start, stop, orbit='descending')) == [
+        'B']
+    assert _ids(spatial.query(AREA, datetime(1995, 6, 1), stop)) == [
+        'B', 'C']
+    assert _ids(spatial.query(AREA, start, stop,
+                              product='single-look')) == ['D']
+    assert spatial.count(AREA, start, stop) == 3
+
+
+def test_query_coverage(data_dir):
+    products = spatial.query(AREA, datetime(1990, 1, 1),
+                             datetime(2010, 1, 1), min_aoi_coverage=0.05)
+    # A covers 1/16 of the area, B 1/16 and C 1/64
+    assert _ids(products) == ['A', 'B']
+    assert products['aoi_coverage'].tolist() == pytest.approx([1 / 16] * 2)
+    assert products['footprint_coverage'].tolist() == pytest.approx(
+        [1, 1 / 9])
+
+
+def test_query_many(data_dir):
+    far = 'POLYGON((9.5 9.5, 12 9.5, 12 12, 9.5 12, 9.5 9.5))'
+    products = spatial.query_many([AREA, far], datetime(1990, 1, 1),
+                                  datetime(2010, 1, 1), footprint='none')
+    assert dict(zip(_ids(products), products['aoi'])) == {
+        'A': (0, ), 'B': (0, ), 'C': (0, ), 'E': (1, )}
+
+
+def test_index_rebuilt_on_catalog_change(data_dir):
+    start, stop = datetime(1990, 1, 1), datetime(2010, 1, 1)
+    assert len(spatial.query(AREA, start, stop)) == 3
+    conn = sqlite3.connect(str(data_dir / 'catalog.db'))
+    conn.execute('DELETE FROM products WHERE id LIKE \'%_A\';')
+    conn.commit()
+    conn.close()
+    assert _ids(spatial.query(AREA, start, stop)) == ['B', 'C']
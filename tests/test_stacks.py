@@ -0,0 +1,125 @@
+"""Stacks and repeat-pass pairs of `asarapi.stacks`."""
+
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from asarapi.stacks import pairs, scenes, stacks
+
+
+def _products(rows):
+    """Query results of (id, date, platform, path, frame, orbit) rows."""
+    products = pd.DataFrame(rows, columns=[
+        'id', 'date', 'platform', 'path', 'frame', 'orbit'])
+    products['date'] = pd.to_datetime(products['date'], format='ISO8601')
+    return products.set_index('id')
+
+
+PRODUCTS = _products([
+    ('a', '2004-01-01', 'Envisat', 1, 10, 'Ascending'),
+    ('b', '2004-02-05', 'ENVISAT', 1, 10, 'ascending'),
+    ('c', '2004-01-01 00:00:30', 'Envisat', 1, 10, 'Ascending'),
+    ('d', '2004-03-11', 'Envisat', 1, 10, 'ASCENDING'),
+    ('e', '2004-01-01', 'Envisat', 1, 10, 'Descending'),
+    ('f', '2004-02-05', 'Envisat', 1, 10, 'Descending'),
+    ('g', '2004-01-01', 'Envisat', 2, 10, 'Ascending'),
+    ('h', '2004-01-01', 'ERS', 1, 10, 'Ascending'),
+    ('i', '2004-01-01', 'Envisat', 1, 11, 'Ascending'),
+])
+
+
+def test_stacks():
+    result = stacks(PRODUCTS)
+    assert list(result) == [
+        ('ENVISAT', 1, 10, 'ASCENDING'), ('ENVISAT', 1, 10, 'DESCENDING'),
+        ('ENVISAT', 1, 11, 'ASCENDING'), ('ENVISAT', 2, 10, 'ASCENDING'),
+        ('ERS', 1, 10, 'ASCENDING')]
+    # Sorted by date, whatever the case of platform and orbit
+    assert list(result[('ENVISAT', 1, 10, 'ASCENDING')].index) == [
+        'a', 'c', 'b', 'd']
+    assert list(result[('ENVISAT', 1, 10, 'DESCENDING')].index) == [
+        'e', 'f']
+
+
+def _brute_force(products, max_baseline, min_baseline=0):
+    keys = {pid: (row.platform.upper(), row.path, row.frame,
+                  row.orbit.upper()) for pid, row in products.iterrows()}
+    found = set()
+    for x, y in itertools.combinations(products.index, 2):
+        days = abs(products.at[x, 'date']
+                   - products.at[y, 'date']) / pd.Timedelta(days=1)
+        if keys[x] == keys[y] and min_baseline <= days <= max_baseline:
+            found.add(frozenset((x, y)))
+    return found
+
+
+@pytest.mark.parametrize('max_baseline, min_baseline', [
+    (0, 0), (35, 0), (35, 35), (35, 1), (70, 0), (70, 36), (34.9, 0)])
+def test_pairs(max_baseline, min_baseline):
+    result = pairs(PRODUCTS, max_baseline, min_baseline)
+    assert set(map(frozenset, zip(result['reference'],
+                                  result['secondary']))) == _brute_force(
+        PRODUCTS, max_baseline, min_baseline)
+    assert len(result) == len(_brute_force(PRODUCTS, max_baseline,
+                                           min_baseline))
+    # The reference is the oldest product, baselines are within the edges
+    assert (result['baseline'] >= min_baseline).all()
+    assert (result['baseline'] <= max_baseline).all()
+    assert (result['secondary_date'] >= result['reference_date']).all()
+    ordered = result.sort_values(
+        ['platform', 'path', 'frame', 'orbit', 'reference_date',
+         'secondary_date'], kind='stable')
+    assert list(ordered.index) == list(result.index)
+
+
+def test_pairs_same_date():
+    # `a` and `c` are 30 s apart, `a` and `a2` acquired at the same time
+    products = pd.concat([PRODUCTS, _products([
+        ('a2', '2004-01-01', 'Envisat', 1, 10, 'Ascending')])])
+    result = pairs(products, 0.5)
+    assert sorted(map(sorted, zip(result['reference'],
+                                  result['secondary']))) == [
+        ['a', 'a2'], ['a', 'c'], ['a2', 'c']]
+    assert result['baseline'].tolist() == pytest.approx(
+        [0, 30 / 86400, 30 / 86400])
+    assert pairs(products, 0.5, min_baseline=0.1).empty
+
+
+def test_pairs_columns():
+    result = pairs(PRODUCTS, 35)
+    assert list(result.columns) == [
+        'reference', 'secondary', 'reference_date', 'secondary_date',
+        'baseline', 'platform', 'path', 'frame', 'orbit']
+    row = result[(result['reference'] == 'e')].iloc[0]
+    assert row['secondary'] == 'f'
+    assert row['baseline'] == 35
+    assert (row['platform'], row['orbit']) == ('ENVISAT', 'DESCENDING')
+
+
+def test_pairs_random():
+    rng = np.random.default_rng(0)
+    n = 200
+    products = _products([
+        (str(i), pd.Timestamp('2003-01-01')
+         + pd.Timedelta(days=int(rng.integers(0, 400))),
+         ['Envisat', 'ERS'][rng.integers(0, 2)], int(rng.integers(1, 4)),
+         10, ['Ascending', 'descending'][rng.integers(0, 2)])
+        for i in range(n)])
+    result = pairs(products, 70, 35)
+    assert set(map(frozenset, zip(result['reference'],
+                                  result['secondary']))) == _brute_force(
+        products, 70, 35)
+
+
+def test_pairs_empty():
+    result = pairs(PRODUCTS.iloc[:0], 35)
+    assert result.empty
+    assert scenes(result) == []
+
+
+def test_scenes():
+    result = pairs(PRODUCTS, 35)
+    # Products in order of first use, each once, unpaired ones left out
+    assert scenes(result) == ['a', 'c', 'b', 'd', 'e', 'f']
@@ -0,0 +1,174 @@
+"""Resumable and segmented downloads against the local stand-in server."""
+
+import hashlib
+import json
+import os
+import sqlite3
+
+import pytest
+import requests
+
+from asarapi import catalog
+from asarapi.transfer import _resume_headers, fetch
+
+DATA = bytes(range(256)) * 4096
+
+
+@pytest.fixture
+def session():
+    with requests.Session() as s:
+        yield s
+
+
+def test_fetch(server, session, tmp_path):
+    server.files['/file'] = DATA
+    path = str(tmp_path / 'file')
+    assert fetch(session, server.url + '/file', path) == path
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+    assert not os.path.exists(path + '.part')
+
+
+def test_fetch_resumes_part_file(server, session, tmp_path):
+    server.files['/file'] = DATA
+    path = str(tmp_path / 'file')
+    with open(path + '.part', 'wb') as f:
+        f.write(DATA[:1000])
+    fetch(session, server.url + '/file', path)
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+    assert server.requests == [('GET', '/file', 'bytes=1000-')]
+
+
+def test_fetch_segments(server, session, tmp_path):
+    server.files['/file'] = DATA
+    path = str(tmp_path / 'file')
+    fetch(session, server.url + '/file', path, connections=4)
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+    ranges = sorted(rng for method, _, rng in server.requests
+                    if method == 'GET')
+    assert len(ranges) == 4 and all(rng for rng in ranges)
+    assert not os.path.exists(path + '.part.json')
+
+
+def test_fetch_segments_short_range(server, session, tmp_path):
+    server.files['/file'] = DATA
+    server.cut['/file'] = 1000
+    path = str(tmp_path / 'file')
+    with pytest.raises(IOError):
+        fetch(session, server.url + '/file', path, connections=4)
+    # No range is recorded as done, all are fetched again on resume
+    with open(path + '.part.json') as f:
+        assert json.load(f)['done'] == []
+    del server.cut['/file']
+    fetch(session, server.url + '/file', path, connections=4)
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+
+
+@pytest.mark.parametrize('connections', [1, 2])
+def test_fetch_segments_other_split(server, session, tmp_path, connections):
+    server.files['/file'] = DATA
+    server.cut['/file'] = 1000
+    path = str(tmp_path / 'file')
+    with pytest.raises(IOError):
+        fetch(session, server.url + '/file', path, connections=4)
+    # The preallocated `.part` file is not a downloaded prefix
+    assert _resume_headers(path) == {}
+    del server.cut['/file']
+    fetch(session, server.url + '/file', path, connections=connections)
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+    assert not os.path.exists(path + '.part.json')
+
+
+def test_fetch_segments_resumes_part_file(server, session, tmp_path):
+    server.files['/file'] = DATA
+    path = str(tmp_path / 'file')
+    with open(path + '.part', 'wb') as f:
+        f.write(DATA[:1000])
+    fetch(session, server.url + '/file', path, connections=4)
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+    ranges = [rng for method, _, rng in server.requests if method == 'GET']
+    assert min(int(rng[6:].split('-')[0]) for rng in ranges) == 1000
+
+
+def test_fetch_segments_complete_part_file(server, session, tmp_path):
+    server.files['/file'] = DATA
+    path = str(tmp_path / 'file')
+    with open(path + '.part', 'wb') as f:
+        f.write(DATA)
+    url = server.url + '/file'
+    response = session.get(url, headers=_resume_headers(path), stream=True)
+    fetch(session, url, path, connections=4, response=response)
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+    # The 416 answer to the resumed request shows the file is complete
+    assert server.requests == [('GET', '/file', 'bytes=%d-' % len(DATA))]
+
+
+def test_fetch_segments_without_ranges(server, session, tmp_path):
+    server.files['/file'] = DATA
+    server.ranges = False
+    path = str(tmp_path / 'file')
+    fetch(session, server.url + '/file', path, connections=4)
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+    assert server.gets('/file') == 1
+
+
+def test_fetch_verify_failure(server, session, tmp_path):
+    server.files['/file'] = DATA
+    path = str(tmp_path / 'file')
+
+    def verify(part_path):
+        raise IOError('invalid')
+
+    with pytest.raises(IOError):
+        fetch(session, server.url + '/file', path, verify=verify)
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + '.part')
+
+
+def _database(path):
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE products (id TEXT PRIMARY KEY);')
+    conn.execute('INSERT INTO products VALUES (\'SAR_IMP_1P\');')
+    conn.commit()
+    conn.close()
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_download_catalog(server, session, tmp_path, monkeypatch):
+    monkeypatch.setattr(catalog, 'DATA_DIR', str(tmp_path / 'data'))
+    data = _database(str(tmp_path / 'published.db'))
+    server.files['/catalog.db'] = data
+    catalog.download_catalog(server.url + '/catalog.db', connections=2,
+                             sha256=hashlib.sha256(data).hexdigest(),
+                             session=session)
+    with open(str(tmp_path / 'data' / 'catalog.db'), 'rb') as f:
+        assert f.read() == data
+
+
+def test_download_catalog_checks_integrity(server, session, tmp_path,
+                                           monkeypatch):
+    monkeypatch.setattr(catalog, 'DATA_DIR', str(tmp_path / 'data'))
+    data = _database(str(tmp_path / 'published.db'))
+    server.files['/catalog.db'] = data[:len(data) // 2] + b'\0' * 100
+    with pytest.raises(IOError):
+        catalog.download_catalog(server.url + '/catalog.db',
+                                 session=session)
+    assert not os.path.exists(str(tmp_path / 'data' / 'catalog.db'))
+
+
+def test_download_catalog_checksum_mismatch(server, session, tmp_path,
+                                            monkeypatch):
+    monkeypatch.setattr(catalog, 'DATA_DIR', str(tmp_path / 'data'))
+    server.files['/catalog.db'] = _database(str(tmp_path / 'published.db'))
+    with pytest.raises(IOError):
+        catalog.download_catalog(server.url + '/catalog.db', sha256='0' * 64,
+                                 session=session)
+    assert not os.path.exists(str(tmp_path / 'data' / 'catalog.db'))